@@ -0,0 +1,94 @@
+"""
+Non-blocking logging for the controllers.
+
+Ryu runs all the handlers on one eventlet loop, so a handler writing to a slow console stalls the
+whole controller. install() moves the handlers of a logger (the root logger by default) behind a
+bounded queue drained by a native thread: emitting a record only renders its message and enqueues
+it, and when the queue is full the record is dropped and counted instead of blocking the loop.
+
+Works on Python 2 and 3, with or without eventlet monkey patching.
+"""
+import logging
+
+try:
+    from eventlet import patcher
+    _threading = patcher.original('threading')
+    try:
+        _queue = patcher.original('queue')
+    except ImportError:
+        _queue = patcher.original('Queue')
+except ImportError:
+    import threading as _threading
+    try:
+        import queue as _queue
+    except ImportError:
+        import Queue as _queue
+
+_STOP = object()
+
+
+class AsyncHandler(logging.Handler):
+    """
+    Handler queueing records for `handlers`, which are only called from the writer thread.
+    """
+    def __init__(self, handlers, maxsize=10000):
+        logging.Handler.__init__(self)
+        self.handlers = list(handlers)
+        for handler in self.handlers:
+            # The writer is a native thread, it must not use locks created by a patched threading
+            handler.lock = _threading.RLock()
+        self.queue = _queue.Queue(maxsize)
+        self.queued = 0
+        self.dropped = 0
+        self._writer = _threading.Thread(target=self._write, name='async-logging')
+        self._writer.daemon = True
+        self._writer.start()
+
+    def emit(self, record):
+        # Render the message now, the arguments may change before the writer gets to it
+        record.msg = record.getMessage()
+        record.args = None
+        try:
+            self.queue.put_nowait(record)
+            self.queued += 1
+        except _queue.Full:
+            self.dropped += 1
+
+    def _write(self):
+        while True:
+            record = self.queue.get()
+            if record is _STOP:
+                return
+            for handler in self.handlers:
+                if record.levelno >= handler.level:
+                    try:
+                        handler.handle(record)
+                    except Exception:
+                        handler.handleError(record)
+
+    def close(self):
+        try:
+            self.queue.put(_STOP, timeout=1.0)
+        except _queue.Full:
+            pass
+        self._writer.join(1.0)
+        for handler in self.handlers:
+            handler.close()
+        logging.Handler.close(self)
+
+
+def install(logger=None, maxsize=10000):
+    """
+    Puts the handlers of `logger` (root by default) behind an AsyncHandler and returns it.
+    Calling it again on the same logger returns the handler already installed.
+    """
+    logger = logger if logger is not None else logging.getLogger()
+    for handler in logger.handlers:
+        if isinstance(handler, AsyncHandler):
+            return handler
+    handlers = list(logger.handlers) or [logging.StreamHandler()]
+    for handler in handlers:
+        logger.removeHandler(handler)
+    handler = AsyncHandler(handlers, maxsize)
+    logger.addHandler(handler)
+    return handler
@@ -0,0 +1,364 @@
+"""
+Offline throughput benchmark for the controller apps, no Mininet or switches needed.
+
+Every app is instantiated against in-memory fake datapaths and a fake topology (switches, links and
+hosts fed through the same events/API the Ryu topology app provides), then a synthetic, seeded
+stream of EventOFPPacketIn (new and repeated TCP flows, ICMP, ARP) and EventOFPPortStatsReply is
+pushed straight into the handlers. Reported per app: packet-ins/s, flow-mods/s and handler latency
+percentiles per event type.
+
+    python bench_controller.py [--apps enhanced,psr,pazzo] [--topology fattree:8] [--packets 20000] [--json]
+
+Run it on every commit and compare the JSON output to track regressions.
+"""
+import argparse
+import importlib.util
+import json
+import logging
+import os
+import random
+import sys
+import time
+
+from ryu.controller import ofp_event
+from ryu.controller.handler import MAIN_DISPATCHER
+from ryu.lib.packet import packet, ethernet, ether_types, arp, ipv4, tcp, icmp
+from ryu.ofproto import ofproto_v1_3, ofproto_v1_3_parser
+from ryu.topology import event, switches
+
+from latency import HdrHistogram
+import topo_generator
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# Same layout as TopoPresentazione.py: server on s1, four hosts on s6, four spines in between
+PRESENTAZIONE = {
+    'switches': [1, 2, 3, 4, 5, 6],
+    'links': [(1, 2, 2, 1), (1, 3, 3, 1), (1, 4, 4, 1), (1, 5, 5, 1),
+              (6, 2, 2, 2), (6, 3, 3, 2), (6, 4, 4, 2), (6, 5, 5, 2)],
+    'hosts': [('00:00:00:00:00:01', '10.0.0.1', 1, 10), ('00:00:00:00:00:02', '10.0.0.2', 6, 11),
+              ('00:00:00:00:00:03', '10.0.0.3', 6, 12), ('00:00:00:00:00:04', '10.0.0.4', 6, 13),
+              ('00:00:00:00:00:05', '10.0.0.5', 6, 14)],
+}
+
+
+def load_topology(spec):
+    # 'presentazione' or a topo_generator spec such as 'fattree:8' or 'leafspine:32,4'
+    if spec == 'presentazione':
+        return PRESENTAZIONE
+    return topo_generator.generate(spec)
+
+
+class FakeDatapath(object):
+    """
+    Stands in for ryu.controller.controller.Datapath: serializes what the app sends, like the real
+    one does, and counts it by message type instead of writing it to a socket.
+    """
+    def __init__(self, dpid):
+        self.id = dpid
+        self.ofproto = ofproto_v1_3
+        self.ofproto_parser = ofproto_v1_3_parser
+        self.xid = 0
+        self.sent = {}
+
+    def set_xid(self, msg):
+        self.xid += 1
+        msg.set_xid(self.xid)
+        return self.xid
+
+    def send_msg(self, msg):
+        if msg.xid is None:
+            self.set_xid(msg)
+        msg.serialize()
+        name = type(msg).__name__
+        self.sent[name] = self.sent.get(name, 0) + 1
+
+
+class FakeNetwork(object):
+    """
+    Ryu topology objects for a topology description:
+    {'switches': [dpid], 'links': [(dpid, port, dpid, port)], 'hosts': [(mac, ip, dpid, port)]}
+    Links are listed once and exist in both directions.
+    """
+    def __init__(self, topology):
+        self.topology = topology
+        self.datapaths = dict((dpid, FakeDatapath(dpid)) for dpid in topology['switches'])
+        self.ports = {}
+        self.switches = {}
+        for dpid, datapath in self.datapaths.items():
+            self.switches[dpid] = switches.Switch(datapath)
+        for a, a_port, b, b_port in topology['links']:
+            self._port(a, a_port)
+            self._port(b, b_port)
+        for _, _, dpid, port_no in topology['hosts']:
+            self._port(dpid, port_no)
+        self.links = []
+        for a, a_port, b, b_port in topology['links']:
+            self.links.append(switches.Link(self.ports[(a, a_port)], self.ports[(b, b_port)]))
+            self.links.append(switches.Link(self.ports[(b, b_port)], self.ports[(a, a_port)]))
+        self.hosts = []
+        for mac, ip, dpid, port_no in topology['hosts']:
+            host = switches.Host(mac, self.ports[(dpid, port_no)])
+            host.ipv4.append(ip)
+            self.hosts.append(host)
+
+    def _port(self, dpid, port_no):
+        if (dpid, port_no) in self.ports:
+            return
+        ofpport = ofproto_v1_3_parser.OFPPort(port_no, '02:00:%02x:%02x:%02x:%02x' % (
+            (dpid >> 16) & 0xff, (dpid >> 8) & 0xff, dpid & 0xff, port_no & 0xff), b'p%d' % port_no,
+            0, 0, 0, 0, 0, 0, 10000000, 10000000)
+        self.switches[dpid].add_port(ofpport)
+        self.ports[(dpid, port_no)] = self.switches[dpid].ports[-1]
+
+    # Replacements for ryu.topology.api
+    def get_switch(self, app, dpid=None):
+        return [self.switches[dpid]] if dpid is not None else list(self.switches.values())
+
+    def get_link(self, app, dpid=None):
+        return [link for link in self.links if dpid is None or link.src.dpid == dpid]
+
+    def get_host(self, app, dpid=None):
+        return [host for host in self.hosts if dpid is None or host.port.dpid == dpid]
+
+    def flow_mods(self):
+        return sum(datapath.sent.get('OFPFlowMod', 0) for datapath in self.datapaths.values())
+
+
+def load_module(filename, name):
+    spec = importlib.util.spec_from_file_location(name, os.path.join(HERE, filename))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def features_event(datapath):
+    msg = ofproto_v1_3_parser.OFPSwitchFeatures(datapath, datapath_id=datapath.id, n_buffers=0, n_tables=254,
+                                                auxiliary_id=0, capabilities=0)
+    return ofp_event.EventOFPSwitchFeatures(msg)
+
+
+def packet_in_event(datapath, in_port, data):
+    msg = ofproto_v1_3_parser.OFPPacketIn(datapath, buffer_id=ofproto_v1_3.OFP_NO_BUFFER, total_len=len(data),
+                                          reason=ofproto_v1_3.OFPR_NO_MATCH, table_id=0, cookie=0,
+                                          match=ofproto_v1_3_parser.OFPMatch(in_port=in_port), data=data)
+    return ofp_event.EventOFPPacketIn(msg)
+
+
+def port_stats_event(datapath, ports, counters, duration):
+    body = [ofproto_v1_3_parser.OFPPortStats(port_no=port_no, rx_packets=counters[port_no] // 1000,
+                                             tx_packets=counters[port_no] // 1000, rx_bytes=counters[port_no],
+                                             tx_bytes=counters[port_no], rx_dropped=0, tx_dropped=0, rx_errors=0,
+                                             tx_errors=0, rx_frame_err=0, rx_over_err=0, rx_crc_err=0, collisions=0,
+                                             duration_sec=int(duration), duration_nsec=int(duration % 1 * 1e9))
+            for port_no in ports]
+    return ofp_event.EventOFPPortStatsReply(ofproto_v1_3_parser.OFPPortStatsReply(datapath, body=body))
+
+
+def tcp_frame(src, dst, src_port, dst_port):
+    pkt = packet.Packet()
+    pkt.add_protocol(ethernet.ethernet(dst=dst[0], src=src[0], ethertype=ether_types.ETH_TYPE_IP))
+    pkt.add_protocol(ipv4.ipv4(src=src[1], dst=dst[1], proto=6))
+    pkt.add_protocol(tcp.tcp(src_port=src_port, dst_port=dst_port))
+    pkt.serialize()
+    return bytes(pkt.data)
+
+
+def icmp_frame(src, dst):
+    pkt = packet.Packet()
+    pkt.add_protocol(ethernet.ethernet(dst=dst[0], src=src[0], ethertype=ether_types.ETH_TYPE_IP))
+    pkt.add_protocol(ipv4.ipv4(src=src[1], dst=dst[1], proto=1))
+    pkt.add_protocol(icmp.icmp(data=icmp.echo(id_=1, seq=1, data=b'x' * 56)))
+    pkt.serialize()
+    return bytes(pkt.data)
+
+
+def arp_frame(src, dst_ip):
+    pkt = packet.Packet()
+    pkt.add_protocol(ethernet.ethernet(dst='ff:ff:ff:ff:ff:ff', src=src[0], ethertype=ether_types.ETH_TYPE_ARP))
+    pkt.add_protocol(arp.arp(opcode=arp.ARP_REQUEST, src_mac=src[0], src_ip=src[1],
+                             dst_mac='00:00:00:00:00:00', dst_ip=dst_ip))
+    pkt.serialize()
+    return bytes(pkt.data)
+
+
+def build_stream(topology, packets, seed, new_flow_ratio=0.3, arp_ratio=0.1, icmp_ratio=0.05):
+    """
+    Returns [(event type, dpid, in_port, frame)] packet-ins at the hosts' edge ports.
+    """
+    rng = random.Random(seed)
+    hosts = topology['hosts']
+    flows = []
+    frames = {}
+    stream = []
+    for _ in range(packets):
+        src = rng.choice(hosts)
+        dst = rng.choice([host for host in hosts if host is not src] or hosts)
+        draw = rng.random()
+        if draw < arp_ratio:
+            kind, key = 'arp', ('arp', src[0], dst[1])
+        elif draw < arp_ratio + icmp_ratio:
+            kind, key = 'icmp', ('icmp', src[0], dst[0])
+        elif not flows or draw < arp_ratio + icmp_ratio + new_flow_ratio:
+            kind, key = 'tcp_new', ('tcp', src, dst, rng.randint(1024, 65535), 80)
+            flows.append(key)
+        else:
+            kind, key = 'tcp_repeat', rng.choice(flows)
+            src = key[1]
+        if key not in frames:
+            if key[0] == 'arp':
+                frames[key] = arp_frame(src, dst[1])
+            elif key[0] == 'icmp':
+                frames[key] = icmp_frame(src, dst)
+            else:
+                frames[key] = tcp_frame(key[1], key[2], key[3], key[4])
+        stream.append((kind, src[2], src[3], frames[key]))
+    return stream
+
+
+def setup_enhanced(network):
+    module = load_module('monitor-swithing.py', 'monitor_swithing')
+    app = module.EnhancedHopByHopSwitch()
+    app.metrics_enabled = False
+    for datapath in network.datapaths.values():
+        app.switch_features_handler(features_event(datapath))
+        state = ofp_event.EventOFPStateChange(datapath)
+        state.state = MAIN_DISPATCHER
+        app._state_change_handler(state)
+        app._switch_enter_handler(event.EventSwitchEnter(network.switches[datapath.id]))
+    for link in network.links:
+        app._link_add_handler(event.EventLinkAdd(link))
+    for host in network.hosts:
+        app._host_add_handler(event.EventHostAdd(host))
+    return app, app._packet_in_handler, app._port_stats_reply_handler
+
+
+def setup_psr(network):
+    module = load_module('idk.py', 'idk')
+    app = module.PsrSwitch()
+    for datapath in network.datapaths.values():
+        app.switch_features_handler(features_event(datapath))
+        app.link_loads[datapath.id] = {}
+    return app, app._packet_in_handler, None
+
+
+def setup_pazzo(network):
+    module = load_module('pazzo.py', 'pazzo')
+    # The app asks ryu.topology.api for switches and links, answer from the fake network instead
+    module.get_switch = network.get_switch
+    module.get_link = network.get_link
+    module.get_all_switch = lambda app: network.get_switch(app)
+    module.get_all_link = lambda app: network.get_link(app)
+    app = module.SimpleSwitch13()
+    for datapath in network.datapaths.values():
+        app.switch_features_handler(features_event(datapath))
+        app.handler_switch_enter(event.EventSwitchEnter(network.switches[datapath.id]))
+    # pazzo learns host addresses from ARP only
+    for mac, ip, dpid, port_no in network.topology['hosts']:
+        app._packet_in_handler(packet_in_event(network.datapaths[dpid], port_no, arp_frame((mac, ip), ip)))
+    return app, app._packet_in_handler, None
+
+
+APPS = {'enhanced': setup_enhanced, 'psr': setup_psr, 'pazzo': setup_pazzo}
+
+
+def run(name, topology, stream, stats_every, seed):
+    network = FakeNetwork(topology)
+    app, packet_in_handler, stats_handler = APPS[name](network)
+    events = [(kind, packet_in_event(network.datapaths[dpid], in_port, frame))
+              for kind, dpid, in_port, frame in stream]
+    flow_mods_before = network.flow_mods()
+    latencies = {}
+    errors = {}
+    clock = time.perf_counter
+    started = clock()
+    for kind, ev in events:
+        before = clock()
+        try:
+            packet_in_handler(ev)
+        except Exception as e:
+            key = '%s: %s' % (type(e).__name__, e)
+            errors[key] = errors.get(key, 0) + 1
+        histogram = latencies.get(kind)
+        if histogram is None:
+            histogram = latencies[kind] = HdrHistogram()
+        histogram.record((clock() - before) * 1e9)
+    elapsed = clock() - started
+    flow_mods = network.flow_mods() - flow_mods_before
+
+    stats = None
+    if stats_handler is not None and stats_every:
+        rng = random.Random(seed)
+        replies = []
+        for i in range(max(1, len(stream) // stats_every)):
+            dpid = rng.choice(topology['switches'])
+            ports = [port.port_no for port in network.switches[dpid].ports]
+            counters = dict((port_no, (i + 1) * 125000 * (port_no + 1)) for port_no in ports)
+            replies.append(port_stats_event(network.datapaths[dpid], ports, counters, i + 1))
+        histogram = HdrHistogram()
+        stats_started = clock()
+        for ev in replies:
+            before = clock()
+            stats_handler(ev)
+            histogram.record((clock() - before) * 1e9)
+        stats = {'replies': len(replies), 'per_second': len(replies) / (clock() - stats_started),
+                 'latency_us': dict(zip(('p50', 'p99', 'p999'),
+                                        [value / 1e3 for value in histogram.percentiles((0.5, 0.99, 0.999))]))}
+
+    result = {
+        'app': name,
+        'switches': len(topology['switches']),
+        'packet_ins': len(events),
+        'packet_ins_per_second': len(events) / elapsed,
+        'flow_mods': flow_mods,
+        'flow_mods_per_second': flow_mods / elapsed,
+        'latency_us': {},
+        'port_stats': stats,
+        'errors': errors,
+    }
+    for kind, histogram in sorted(latencies.items()):
+        p50, p99, p999 = histogram.percentiles((0.5, 0.99, 0.999))
+        result['latency_us'][kind] = {'count': histogram.count, 'p50': p50 / 1e3, 'p99': p99 / 1e3, 'p999': p999 / 1e3}
+    return result
+
+
+def print_result(result):
+    print('%s (%d switches): %d packet-ins, %.0f packet-ins/s, %d flow-mods, %.0f flow-mods/s' % (
+        result['app'], result['switches'], result['packet_ins'], result['packet_ins_per_second'],
+        result['flow_mods'], result['flow_mods_per_second']))
+    for kind, stats in result['latency_us'].items():
+        print('  %-10s %7d  p50 %8.1fus  p99 %8.1fus  p999 %8.1fus' % (
+            kind, stats['count'], stats['p50'], stats['p99'], stats['p999']))
+    if result['port_stats']:
+        stats = result['port_stats']
+        print('  port stats %d replies, %.0f replies/s, p50 %.1fus p99 %.1fus' % (
+            stats['replies'], stats['per_second'], stats['latency_us']['p50'], stats['latency_us']['p99']))
+    for error, count in result['errors'].items():
+        print('  %d x %s' % (count, error))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--apps', default='enhanced,psr,pazzo')
+    parser.add_argument('--topology', default='presentazione',
+                        help="'presentazione' or a topo_generator spec: fattree:K, leafspine:L,S[,H], ring:N[,H], "
+                             "random:N,D[,SEED]")
+    parser.add_argument('--packets', type=int, default=20000)
+    parser.add_argument('--stats-every', type=int, default=50, help='one port stats reply per N packet-ins, 0 disables')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--json', action='store_true', help='one JSON object per app instead of text')
+    args = parser.parse_args(argv)
+
+    logging.getLogger().setLevel(logging.WARNING)
+    topology = load_topology(args.topology)
+    stream = build_stream(topology, args.packets, args.seed)
+    for name in args.apps.split(','):
+        result = run(name, topology, stream, args.stats_every, args.seed)
+        if args.json:
+            print(json.dumps(result, sort_keys=True))
+        else:
+            print_result(result)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,80 @@
+"""
+Micro-benchmark of the packet-in header parsing: full ryu.lib.packet parsing, as the handlers used
+to do, against fastpath.parse_headers.
+
+    python bench_packet_parser.py [iterations]
+"""
+import sys
+import timeit
+
+from ryu.lib.packet import packet, ethernet, ether_types, arp, ipv4, tcp, udp, icmp, vlan
+
+from fastpath import parse_headers
+
+
+def build_frames():
+    frames = {}
+
+    pkt = packet.Packet()
+    pkt.add_protocol(ethernet.ethernet(dst='00:00:00:00:00:02', src='00:00:00:00:00:01', ethertype=ether_types.ETH_TYPE_IP))
+    pkt.add_protocol(ipv4.ipv4(src='10.0.0.1', dst='10.0.0.2', proto=6))
+    pkt.add_protocol(tcp.tcp(src_port=40000, dst_port=80))
+    pkt.add_protocol(b'x' * 1400)
+    pkt.serialize()
+    frames['tcp'] = bytes(pkt.data)
+
+    pkt = packet.Packet()
+    pkt.add_protocol(ethernet.ethernet(dst='00:00:00:00:00:02', src='00:00:00:00:00:01', ethertype=ether_types.ETH_TYPE_8021Q))
+    pkt.add_protocol(vlan.vlan(vid=10, ethertype=ether_types.ETH_TYPE_IP))
+    pkt.add_protocol(ipv4.ipv4(src='10.0.0.1', dst='10.0.0.2', proto=17))
+    pkt.add_protocol(udp.udp(src_port=5000, dst_port=53))
+    pkt.serialize()
+    frames['vlan_udp'] = bytes(pkt.data)
+
+    pkt = packet.Packet()
+    pkt.add_protocol(ethernet.ethernet(dst='00:00:00:00:00:02', src='00:00:00:00:00:01', ethertype=ether_types.ETH_TYPE_IP))
+    pkt.add_protocol(ipv4.ipv4(src='10.0.0.1', dst='10.0.0.2', proto=1))
+    pkt.add_protocol(icmp.icmp(data=icmp.echo(id_=1, seq=1, data=b'x' * 56)))
+    pkt.serialize()
+    frames['icmp'] = bytes(pkt.data)
+
+    pkt = packet.Packet()
+    pkt.add_protocol(ethernet.ethernet(dst='ff:ff:ff:ff:ff:ff', src='00:00:00:00:00:01', ethertype=ether_types.ETH_TYPE_ARP))
+    pkt.add_protocol(arp.arp(opcode=arp.ARP_REQUEST, src_mac='00:00:00:00:00:01', src_ip='10.0.0.1',
+                             dst_mac='00:00:00:00:00:00', dst_ip='10.0.0.2'))
+    pkt.serialize()
+    frames['arp'] = bytes(pkt.data)
+    return frames
+
+
+def ryu_parse(data):
+    # What the packet-in handlers did before fastpath
+    pkt = packet.Packet(data)
+    eth = pkt.get_protocol(ethernet.ethernet)
+    ip = pkt.get_protocol(ipv4.ipv4)
+    if ip is not None:
+        l4 = pkt.get_protocol(tcp.tcp) or pkt.get_protocol(udp.udp)
+        return (eth.ethertype, eth.dst, eth.src, ip.src, ip.dst, ip.proto,
+                l4.src_port if l4 else None, l4.dst_port if l4 else None)
+    arp_pkt = pkt.get_protocol(arp.arp)
+    if arp_pkt is not None:
+        return (eth.ethertype, eth.dst, eth.src, arp_pkt.src_ip, arp_pkt.dst_ip, arp_pkt.opcode,
+                arp_pkt.src_mac, arp_pkt.dst_mac)
+    return eth.ethertype, eth.dst, eth.src, None, None, None, None, None
+
+
+def main(iterations=20000):
+    print('%-10s %14s %14s %8s' % ('frame', 'ryu (us/pkt)', 'fast (us/pkt)', 'speedup'))
+    for name, data in sorted(build_frames().items()):
+        slow = ryu_parse(data)
+        fast = parse_headers(data)
+        # VLAN tags are skipped by the fast parser, Ryu reports the outer ethertype
+        if name != 'vlan_udp':
+            assert slow == fast, (name, slow, fast)
+        ryu_time = min(timeit.repeat(lambda: ryu_parse(data), number=iterations, repeat=3)) / iterations
+        fast_time = min(timeit.repeat(lambda: parse_headers(data), number=iterations, repeat=3)) / iterations
+        print('%-10s %14.2f %14.2f %7.1fx' % (name, ryu_time * 1e6, fast_time * 1e6, ryu_time / fast_time))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 20000)
@@ -0,0 +1,79 @@
+"""
+Low-allocation header parser for packet-in data.
+
+parse_headers() reads the few fields the controllers need straight from the raw frame with
+precompiled structs and unpack_from, without building a ryu.lib.packet.Packet and one object per
+layer. It works on Python 2 and 3 with bytes, bytearray or memoryview.
+
+The result is a plain tuple:
+
+    (ethertype, eth_dst, eth_src, ip_src, ip_dst, proto, l4_src, l4_dst)
+
+- IPv4: proto is the IP protocol, l4_src/l4_dst are the TCP/UDP ports (None for other protocols
+  and for non-first fragments).
+- ARP: ip_src/ip_dst are the sender/target protocol addresses, proto is the opcode and
+  l4_src/l4_dst are the sender/target hardware addresses.
+- Anything else: only the Ethernet fields are set.
+
+VLAN (802.1Q and 802.1ad) tags are skipped, ethertype is the one of the payload.
+Returns None when the frame is shorter than an Ethernet header.
+"""
+import struct
+
+ETH_TYPE_IP = 0x0800
+ETH_TYPE_ARP = 0x0806
+ETH_TYPE_LLDP = 0x88cc
+_VLAN_TYPES = (0x8100, 0x88a8, 0x9100)
+
+IPPROTO_ICMP = 1
+IPPROTO_TCP = 6
+IPPROTO_UDP = 17
+
+# Indexes in the tuple returned by parse_headers
+ETHERTYPE, ETH_DST, ETH_SRC, IP_SRC, IP_DST, PROTO, L4_SRC, L4_DST = range(8)
+
+_ETH = struct.Struct('!6B6BH')
+_VLAN = struct.Struct('!2xH')
+_IPV4 = struct.Struct('!B5xHx B2x4B4B')
+_ARP = struct.Struct('!6xH6B4B6B4B')
+_PORTS = struct.Struct('!HH')
+
+_MAC = '%02x:%02x:%02x:%02x:%02x:%02x'
+_IP = '%d.%d.%d.%d'
+
+_ETH_LEN = _ETH.size
+_NONE_TAIL = (None, None, None, None, None)
+
+
+def parse_headers(data):
+    if len(data) < _ETH_LEN:
+        return None
+    eth = _ETH.unpack_from(data, 0)
+    eth_dst = _MAC % eth[0:6]
+    eth_src = _MAC % eth[6:12]
+    ethertype = eth[12]
+    offset = _ETH_LEN
+    while ethertype in _VLAN_TYPES and len(data) >= offset + _VLAN.size:
+        ethertype = _VLAN.unpack_from(data, offset)[0]
+        offset += _VLAN.size
+
+    if ethertype == ETH_TYPE_IP:
+        if len(data) < offset + _IPV4.size:
+            return (ethertype, eth_dst, eth_src) + _NONE_TAIL
+        ip = _IPV4.unpack_from(data, offset)
+        proto = ip[2]
+        l4_src = l4_dst = None
+        # Ports are only in the first fragment
+        if proto in (IPPROTO_TCP, IPPROTO_UDP) and not ip[1] & 0x1fff:
+            l4_offset = offset + (ip[0] & 0x0f) * 4
+            if len(data) >= l4_offset + _PORTS.size:
+                l4_src, l4_dst = _PORTS.unpack_from(data, l4_offset)
+        return ethertype, eth_dst, eth_src, _IP % ip[3:7], _IP % ip[7:11], proto, l4_src, l4_dst
+
+    if ethertype == ETH_TYPE_ARP:
+        if len(data) < offset + _ARP.size:
+            return (ethertype, eth_dst, eth_src) + _NONE_TAIL
+        a = _ARP.unpack_from(data, offset)
+        return ethertype, eth_dst, eth_src, _IP % a[7:11], _IP % a[17:21], a[0], _MAC % a[1:7], _MAC % a[11:17]
+
+    return (ethertype, eth_dst, eth_src) + _NONE_TAIL
@@ -7,6 +7,8 @@ import json
 import time
 from operator import attrgetter
 import copy
+from timeseries import CounterStore, PORT_FIELDS, clock
+from stats_scheduler import StatsPollScheduler
 
 class SimpleMonitor13(simple_switch_13.SimpleSwitch13):
   metrics = {}
@@ -17,6 +19,13 @@ class SimpleMonitor13(simple_switch_13.SimpleSwitch13):
     self.monitor_thread = hub.spawn(self._monitor)
     self.metrics = {}
     self.deltas = {}
+    # Bounded counter history per (dpid, port_no), 120 samples = one hour at 30s
+    self.port_history = CounterStore(120, PORT_FIELDS)
+    # Staggered polling, 5s for busy switches up to 120s for idle ones
+    self.poll_scheduler = StatsPollScheduler(self._poll_datapath, base_period=30, min_period=5, max_period=120)
+    # Switches moving more than this many bytes/s over all ports are polled faster
+    self.active_rate_threshold = 125000
+    self.last_sample_time = {}
 
 # Fills controller table with currently connected switches (dynamic)
   @set_ev_cls(ofp_event.EventOFPStateChange, [MAIN_DISPATCHER, DEAD_DISPATCHER])
@@ -28,23 +37,35 @@ class SimpleMonitor13(simple_switch_13.SimpleSwitch13):
         # Check if the datapath is not already registered
         self.logger.debug('register datapath: %016x', datapath.id)
         self.datapaths[datapath.id] = datapath  # Register the datapath in a dictionary
+        self.poll_scheduler.add(datapath.id)
     elif ev.state == DEAD_DISPATCHER:
       # Handler for when the datapath (switch) transitions to DEAD_DISPATCHER state -> disconnected
       if datapath.id in self.datapaths:
         # Check if the datapath is currently registered
         self.logger.debug('unregister datapath: %016x', datapath.id)
         del self.datapaths[datapath.id]  # Unregister and remove the datapath from the dictionary
+        self.poll_scheduler.remove(datapath.id)
+        self.port_history.drop_group(datapath.id)
+        self.last_sample_time.pop(datapath.id, None)
       
-  # Asks for stats for all switches each sleep_timer
+  # Lets the scheduler ask for stats when each switch is due, prints the dicts each sleep_timer
   def _monitor(self):
     sleep_timer = 30
+    next_print = time.time() + sleep_timer
     while True:
-      hub.sleep(sleep_timer)
-      for dp in self.datapaths.values():
-        self._request_stats(dp)
-      self.periodic_print()
-      self.periodic_print_deltas()
+      wait = self.poll_scheduler.tick()
+      now = time.time()
+      if now >= next_print:
+        self.periodic_print()
+        self.periodic_print_deltas()
+        next_print = now + sleep_timer
+      hub.sleep(min(wait, next_print - now))
 
+  def _poll_datapath(self, dpid):
+    datapath = self.datapaths.get(dpid)
+    if datapath is None:
+      return ()
+    return self._request_stats(datapath)
 
   def _request_stats(self, datapath):
     # Log a debug message indicating that statistics requests are being sent to the specified datapath
@@ -63,17 +84,23 @@ class SimpleMonitor13(simple_switch_13.SimpleSwitch13):
     req = parser.OFPPortStatsRequest(datapath, 0, ofproto.OFPP_ANY)
     datapath.send_msg(req)
 
+    # Only port stats are handled, the scheduler waits for that reply before polling again
+    return ('port',)
+
   # Handle replies for each switch
   @set_ev_cls(ofp_event.EventOFPPortStatsReply, MAIN_DISPATCHER)
   def _port_stats_reply_handler(self, ev):
     switch_id = ev.msg.datapath.id
     port_traffic = {}
+    received = clock()
     # Sorts replies for each switch by port number, iterates through them and prints
     self.logger.debug("---------------------------")
     self.logger.debug("Switch: %03x", switch_id)
     for stat in sorted(ev.msg.body, key=attrgetter("port_no")):
       total_traffic = stat.rx_bytes + stat.tx_bytes
       port_traffic[stat.port_no] = total_traffic
+      self.port_history.append((switch_id, stat.port_no), received,
+                               (stat.rx_bytes, stat.tx_bytes, stat.rx_packets, stat.tx_packets))
       # TODO if to discard giant port
     for key in port_traffic.keys():
       self.logger.debug("%8d: %8d", key, port_traffic.get(key))
@@ -85,6 +112,12 @@ class SimpleMonitor13(simple_switch_13.SimpleSwitch13):
         self.metrics[switch_id] = port_traffic
       else:
         self.metrics[switch_id].update(port_traffic)
+    self.poll_scheduler.reply(switch_id, 'port')
+    last = self.last_sample_time.get(switch_id)
+    self.last_sample_time[switch_id] = received
+    if last is not None and received > last and switch_id in self.deltas:
+      rate = sum(self.deltas[switch_id].values()) / (received - last)
+      self.poll_scheduler.report_activity(switch_id, rate >= self.active_rate_threshold)
 
   def periodic_print(self):
     print("##########################")
@@ -3,8 +3,9 @@ from ryu.controller import ofp_event
 from ryu.controller.handler import CONFIG_DISPATCHER, MAIN_DISPATCHER
 from ryu.controller.handler import set_ev_cls
 from ryu.ofproto import ofproto_v1_3
-from ryu.lib.packet import packet, ethernet, ether_types, ipv4, icmp
+from ryu.lib.packet import ether_types
 import time
+from fastpath import parse_headers, IPPROTO_ICMP
 
 class PsrSwitch(app_manager.RyuApp):
     OFP_VERSIONS = [ofproto_v1_3.OFP_VERSION]
@@ -55,25 +56,19 @@ class PsrSwitch(app_manager.RyuApp):
         in_port = msg.match['in_port']
         dpid = datapath.id
 
-        pkt = packet.Packet(msg.data)
-        eth = pkt.get_protocol(ethernet.ethernet)
+        headers = parse_headers(msg.data)
 
-        assert eth is not None
+        assert headers is not None
 
-        dst = eth.dst
-        src = eth.src
+        ethertype, dst, src, _, _, ip_proto = headers[:6]
 
-        if eth.ethertype == ether_types.ETH_TYPE_LLDP:
+        if ethertype == ether_types.ETH_TYPE_LLDP:
             return
 
         # Handle ICMP packets separately
-        if eth.ethertype == ether_types.ETH_TYPE_IP:
-            ip_pkt = pkt.get_protocol(ipv4.ipv4)
-            if ip_pkt and ip_pkt.proto == ipv4.IPPROTO_ICMP:
-                icmp_pkt = pkt.get_protocol(icmp.icmp)
-                if icmp_pkt:
-                    self.handle_icmp_packet(datapath, pkt, in_port)
-                    return
+        if ethertype == ether_types.ETH_TYPE_IP and ip_proto == IPPROTO_ICMP:
+            self.handle_icmp_packet(datapath, msg.data, in_port)
+            return
 
         # Initialize visited switches list for this packet
         if src not in self.visited_switches:
@@ -132,7 +127,7 @@ class PsrSwitch(app_manager.RyuApp):
             )
             datapath.send_msg(ofmsg)
 
-    def handle_icmp_packet(self, datapath, pkt, in_port):
+    def handle_icmp_packet(self, datapath, data, in_port):
         # Flood ICMP packets
         ofproto = datapath.ofproto
         parser = datapath.ofproto_parser
@@ -142,7 +137,7 @@ class PsrSwitch(app_manager.RyuApp):
             buffer_id=ofproto.OFP_NO_BUFFER,
             in_port=in_port,
             actions=actions,
-            data=pkt.data
+            data=data
         )
         datapath.send_msg(out)
 
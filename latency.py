@@ -0,0 +1,113 @@
+"""
+HDR-style latency histograms for per-stage timing of controller handlers.
+
+Values are recorded as integer nanoseconds in log-linear buckets: every power of two is split into
+2**(precision_bits - 1) linear sub-buckets, so any recorded value is known within a relative error
+of 2**-(precision_bits - 1) (below 1% with the default 8 bits) whatever its magnitude, and the
+memory used only grows with the number of distinct buckets actually hit.
+"""
+import time
+
+_clock = getattr(time, 'perf_counter', time.time)
+
+
+class HdrHistogram(object):
+    __slots__ = ('precision_bits', 'counts', 'count', 'max')
+
+    def __init__(self, precision_bits=8):
+        self.precision_bits = precision_bits
+        # bucket key -> count, see _key()
+        self.counts = {}
+        self.count = 0
+        self.max = 0
+
+    def _key(self, value):
+        shift = value.bit_length() - self.precision_bits
+        if shift <= 0:
+            return value
+        return (shift << self.precision_bits) | (value >> shift)
+
+    def _bounds(self, key):
+        shift = key >> self.precision_bits
+        if shift == 0:
+            return key, key
+        mantissa = key & ((1 << self.precision_bits) - 1)
+        return mantissa << shift, ((mantissa + 1) << shift) - 1
+
+    def record(self, value):
+        value = int(value)
+        if value < 0:
+            value = 0
+        key = self._key(value)
+        self.counts[key] = self.counts.get(key, 0) + 1
+        self.count += 1
+        if value > self.max:
+            self.max = value
+
+    def percentiles(self, quantiles):
+        """
+        Values at the given quantiles (0-1), as the upper bound of the bucket they fall in.
+        """
+        if not self.count:
+            return [None] * len(quantiles)
+        keys = sorted(self.counts)
+        results = []
+        index = 0
+        seen = self.counts[keys[0]]
+        for quantile in quantiles:
+            rank = max(1, int(quantile * self.count + 0.5))
+            while seen < rank and index + 1 < len(keys):
+                index += 1
+                seen += self.counts[keys[index]]
+            results.append(min(self._bounds(keys[index])[1], self.max))
+        return results
+
+
+class StageLatency(object):
+    """
+    HdrHistogram of nanoseconds per (event type, stage). Handlers collect a list of
+    (stage, clock()) stamps, the first one being the start, and pass it to record_stages().
+    """
+    QUANTILES = (0.5, 0.99, 0.999)
+
+    def __init__(self, enabled=False, clock=_clock, precision_bits=8):
+        self.enabled = enabled
+        self.clock = clock
+        self.precision_bits = precision_bits
+        self.histograms = {}
+
+    def record(self, event, stage, seconds):
+        histogram = self.histograms.get((event, stage))
+        if histogram is None:
+            histogram = self.histograms[(event, stage)] = HdrHistogram(self.precision_bits)
+        histogram.record(seconds * 1e9)
+
+    def record_stages(self, event, stamps):
+        for (_, started), (stage, ended) in zip(stamps, stamps[1:]):
+            self.record(event, stage, ended - started)
+        if len(stamps) > 1:
+            self.record(event, 'total', stamps[-1][1] - stamps[0][1])
+
+    def reset(self):
+        self.histograms = {}
+
+    def snapshot(self):
+        """
+        Returns {event: {stage: {'count', 'p50', 'p99', 'p999', 'max'}}} in microseconds.
+        """
+        snapshot = {}
+        for (event, stage), histogram in self.histograms.items():
+            p50, p99, p999 = histogram.percentiles(self.QUANTILES)
+            snapshot.setdefault(event, {})[stage] = {
+                'count': histogram.count, 'p50': p50 / 1e3, 'p99': p99 / 1e3, 'p999': p999 / 1e3,
+                'max': histogram.max / 1e3,
+            }
+        return snapshot
+
+    def format(self):
+        lines = ['%-10s %-10s %10s %10s %10s %10s %10s' % ('event', 'stage', 'count', 'p50 us', 'p99 us', 'p999 us', 'max us')]
+        for event, stages in sorted(self.snapshot().items()):
+            for stage, stats in sorted(stages.items()):
+                lines.append('%-10s %-10s %10d %10.1f %10.1f %10.1f %10.1f' % (
+                    event, stage, stats['count'], stats['p50'], stats['p99'], stats['p999'], stats['max']))
+        return '\n'.join(lines) + '\n'
@@ -0,0 +1,165 @@
+"""
+Minimal Prometheus-style metrics for the controllers.
+
+Counters, gauges and histograms only keep numbers in dicts keyed by label values, so updating them
+in the packet-in path is a couple of dict operations. Gauges can also be computed at scrape time
+from a callable. MetricsRegistry.render() returns the text exposition format (version 0.0.4) and
+serve_connection() answers one HTTP GET on an accepted socket, e.g. from a hub.StreamServer.
+"""
+import bisect
+import math
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def _escape(value):
+    return str(value).replace('\\', r'\\').replace('\n', r'\n').replace('"', r'\"')
+
+
+def _labels(names, values, extra=None):
+    pairs = ['%s="%s"' % (name, _escape(value)) for name, value in zip(names, values)]
+    if extra is not None:
+        pairs.append('%s="%s"' % extra)
+    return '{%s}' % ','.join(pairs) if pairs else ''
+
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    if value == float('-inf'):
+        return '-Inf'
+    if isinstance(value, float) and math.isnan(value):
+        return 'NaN'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric(object):
+    type_name = 'untyped'
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+
+    def samples(self):
+        for labels, value in sorted(self.values.items()):
+            yield self.name, labels, value
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.documentation), '# TYPE %s %s' % (self.name, self.type_name)]
+        for name, labels, value in self.samples():
+            lines.append('%s%s %s' % (name, _labels(self.labelnames, labels), _number(value)))
+        return lines
+
+
+class Counter(Metric):
+    type_name = 'counter'
+
+    def inc(self, amount=1, labels=()):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+
+class Gauge(Metric):
+    """
+    `function`, if given, is called at scrape time and returns either a number or a dict
+    {label values: number}, replacing the values set with set().
+    """
+    type_name = 'gauge'
+
+    def __init__(self, name, documentation, labelnames=(), function=None):
+        super(Gauge, self).__init__(name, documentation, labelnames)
+        self.function = function
+
+    def set(self, value, labels=()):
+        self.values[labels] = value
+
+    def samples(self):
+        if self.function is not None:
+            values = self.function()
+            self.values = values if isinstance(values, dict) else {(): values}
+        return super(Gauge, self).samples()
+
+
+def exponential_buckets(start, factor, count):
+    return tuple(start * factor ** i for i in range(count))
+
+
+class Histogram(Metric):
+    type_name = 'histogram'
+
+    def __init__(self, name, documentation, buckets, labelnames=()):
+        super(Histogram, self).__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, labels=()):
+        series = self.values.get(labels)
+        if series is None:
+            # Per bucket counts (last one is +Inf), sum
+            series = self.values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+        series[0][bisect.bisect_left(self.buckets, value)] += 1
+        series[1] += value
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.documentation), '# TYPE %s histogram' % self.name]
+        for labels, (counts, total) in sorted(self.values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                lines.append('%s_bucket%s %d' % (self.name, _labels(self.labelnames, labels, ('le', _number(bound))),
+                                                 cumulative))
+            lines.append('%s_sum%s %s' % (self.name, _labels(self.labelnames, labels), _number(total)))
+            lines.append('%s_count%s %d' % (self.name, _labels(self.labelnames, labels), cumulative))
+        return lines
+
+
+class MetricsRegistry(object):
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self.register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name, documentation, labelnames=(), function=None):
+        return self.register(Gauge(name, documentation, labelnames, function))
+
+    def histogram(self, name, documentation, buckets, labelnames=()):
+        return self.register(Histogram(name, documentation, buckets, labelnames))
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+def serve_connection(sock, routes, max_request=8192):
+    """
+    Answers a single HTTP GET on `sock`. `routes` maps a path to a callable returning
+    (content type, body text).
+    """
+    try:
+        request = b''
+        while b'\r\n\r\n' not in request and len(request) < max_request:
+            chunk = sock.recv(1024)
+            if not chunk:
+                break
+            request += chunk
+        parts = request.split(b'\r\n', 1)[0].split()
+        path = parts[1].decode('ascii', 'replace').split('?', 1)[0] if len(parts) > 1 else ''
+        route = routes.get(path) if parts and parts[0] == b'GET' else None
+        if route is None:
+            status, content_type, body = '404 Not Found', 'text/plain', 'not found\n'
+        else:
+            status = '200 OK'
+            content_type, body = route()
+        body = body.encode('utf-8')
+        header = 'HTTP/1.0 %s\r\nContent-Type: %s\r\nContent-Length: %d\r\nConnection: close\r\n\r\n' % (
+            status, content_type, len(body))
+        sock.sendall(header.encode('ascii') + body)
+    finally:
+        sock.close()
@@ -4,13 +4,49 @@ from ryu.controller.handler import set_ev_cls, MAIN_DISPATCHER, DEAD_DISPATCHER,
 from ryu.ofproto import ofproto_v1_3
 from ryu.topology import event, switches
 from ryu.topology.api import get_all_switch, get_all_link, get_all_host
-from ryu.lib.packet import packet, ethernet, ether_types, arp, ipv4, tcp
+from ryu.lib.packet import packet, ethernet, ether_types, arp
 from ryu.app import simple_switch_13
 from ryu.lib import hub
+from ryu import cfg
 from operator import attrgetter
 import networkx as nx
 import copy
+import heapq
+import logging
+import time
 from ryu.ofproto import inet, ether
+from timeseries import CounterStore, PORT_FIELDS, FLOW_FIELDS, clock
+from fastpath import parse_headers
+from stats_scheduler import StatsPollScheduler
+import async_logging
+from metrics import MetricsRegistry, exponential_buckets, serve_connection, CONTENT_TYPE
+from latency import StageLatency
+
+ECMP_PRIORITY = 5
+ICMP_FLOW_PRIORITY = 10
+TCP_FLOW_PRIORITY = 20
+# TCP rule granularity -> priority, finer rules win over aggregated ones on the same switch
+GRANULARITY_PRIORITY = {'mac': 14, 'ip_pair': 16, 'five_tuple': TCP_FLOW_PRIORITY}
+PRIORITY_RULE_CLASS = {ICMP_FLOW_PRIORITY: 'icmp', 14: 'mac', 16: 'ip_pair', TCP_FLOW_PRIORITY: 'five_tuple'}
+# Fields identifying a TCP rule whatever its granularity, missing fields are None
+FLOW_KEY_FIELDS = ('eth_dst', 'ipv4_src', 'ipv4_dst', 'tcp_src', 'tcp_dst')
+# Cookie of the ICMP and TCP rules, flow stats requests only ask for these
+FLOW_COOKIE = 0x20
+ARP_RESPONDER_COOKIE = 0xa1
+ARP_RESPONDER_PRIORITY = 30
+# duration_sec reported by switches that do not support port durations
+DURATION_UNSUPPORTED = 0xffffffff
+# Meter limiting the table-miss packet-ins in protection mode
+PACKET_IN_METER_ID = 1
+
+# [metrics] section of the ryu-manager config file
+CONF = cfg.CONF
+CONF.register_opts([
+    cfg.BoolOpt('enabled', default=False, help='Serve /metrics and /latency over HTTP'),
+    cfg.StrOpt('host', default='127.0.0.1', help='Address the metrics endpoint listens on'),
+    cfg.IntOpt('port', default=9765, help='Port the metrics endpoint listens on'),
+    cfg.BoolOpt('latency_enabled', default=False, help='Record per-stage packet-in latency, served on /latency'),
+], group='metrics')
 
 
 class EnhancedHopByHopSwitch(simple_switch_13.SimpleSwitch13):
@@ -23,16 +59,213 @@ class EnhancedHopByHopSwitch(simple_switch_13.SimpleSwitch13):
         self.metrics = {}
         self.deltas = {}
         self.switches = {}
+        # Long-lived topology graph, kept current by the topology events below
+        self.net = nx.DiGraph()
+        # (dpid, port_no) -> neighbour dpid for every inter-switch link
+        self.port_to_neighbor = {}
+        # Routing-table mode: (src_dpid, dst_dpid) -> out_port, rebuilt once per stats epoch
+        self.use_next_hop_table = True
+        self.next_hop_table = {}
+        self.next_hop_table_epoch = -1
+        self.next_hop_table_time = None
+        self.next_hop_table_dirty = True
+        self.stats_epoch = 0
+        self.epoch_interval = 10
+        # Stats requests are staggered over the period and each switch is polled between
+        # 2s (hot or changing) and 60s (idle)
+        self.poll_scheduler = StatsPollScheduler(self._poll_datapath, base_period=10, min_period=2, max_period=60)
+        self.hot_utilization = 0.5
+        self.utilization_change_threshold = 0.05
+        # Hosts indexed by MAC and IPv4, fed by the topology host events
+        self.hosts = HostDirectory()
+        # Pre-serialized ARP replies; after arp_flow_threshold hits the reply is also
+        # installed as an ARP responder flow so repeated requests stay in the switch
+        self.arp_replies = ArpReplyCache(self.hosts)
+        self.install_arp_responder_flows = True
+        self.arp_flow_threshold = 2
+        self.arp_flow_hard_timeout = 60
+        self.arp_responder_switches = set()
+        self.arp_responder_removals = 0
+        # Per-port, per-direction rates in bit/s smoothed with an EWMA, and utilization as a
+        # fraction of the port curr_speed. Path weights are built from the tx utilization.
+        self.ewma_alpha = 0.3
+        self.default_link_capacity = 1e9
+        self.link_hop_cost = 0.001
+        self.port_capacity = {}
+        self.port_samples = {}
+        self.port_rates = {}
+        self.utilization = {}
+        # Bounded counter history per (dpid, port_no), e.g. one hour at the 10s polling period
+        self.history_capacity = 360
+        self.port_history = CounterStore(self.history_capacity, PORT_FIELDS)
+        # TCP rule granularity: 'mac' (per destination MAC), 'ip_pair' or 'five_tuple'. In hybrid mode
+        # only the ingress switch uses it, transit and egress switches use per destination MAC rules.
+        self.flow_granularity = 'five_tuple'
+        self.hybrid_granularity = False
+        # Rules per switch and class ('icmp', 'mac', 'ip_pair', 'five_tuple') seen in the last flow stats
+        self.rule_counts = {}
+        self._rule_count_parts = {}
+        # Per-switch TCP rule rates from flow stats, key (see FLOW_KEY_FIELDS) -> (bit/s, bytes)
+        self.flow_samples = {}
+        self.flow_rates = {}
+        self.flow_history = CounterStore(30, FLOW_FIELDS)
+        self._flow_reply_seen = {}
+        # A flow is an elephant once it is both fast and large enough
+        self.elephant_rate_bps = 1e6
+        self.elephant_min_bytes = 1024 * 1024
+        self.top_flows_count = 10
+        # Install the whole path at the ingress switch instead of one rule per packet-in
+        self.install_full_path = True
+        # ECMP mode: proactive per-destination-MAC rules pointing at OFPGT_SELECT groups with one
+        # bucket per equal-hop next hop, weighted by spare capacity and refreshed every epoch.
+        # IP traffic to known hosts then never reaches the controller, which also starves the
+        # per-flow features above, hence off by default.
+        self.ecmp_enabled = False
+        self.ecmp_weight_steps = 10
+        self.ecmp_group_ids = {}
+        self.ecmp_groups = {}
+        self.ecmp_rules = {}
+        # Installed TCP rules: key -> {'ingress', 'egress', 'dst_port', 'match', 'priority', 'hops': {dpid: out_port}}
+        self.flow_routes = {}
+        # Periodic rebalancer moving the fastest flows off links above rebalance_threshold
+        self.rebalance_enabled = True
+        self.rebalance_threshold = 0.7
+        self.max_moves_per_epoch = 4
+        self.barrier_timeout = 1.0
+        self._barrier_waits = []
+        # Packet-in protection: a pkt/s meter on the table-miss rule of the switches that support
+        # meters plus a token bucket per datapath in the controller. Excess packet-ins are dropped
+        # or, with the 'flood' policy (loop-free topologies only), flooded without any processing.
+        self.packet_in_protection = False
+        self.packet_in_rate = 500
+        self.packet_in_burst = 100
+        self.packet_in_shed_policy = 'drop'
+        self.packet_in_buckets = {}
+        self.packet_in_metered = set()
+        self.packet_in_admitted = {}
+        self.packet_in_shed = {}
+        # TCP flows whose rule was just sent: (dpid, eth_dst, ipv4_src, ipv4_dst, tcp_src, tcp_dst) ->
+        # (expiry, out port). Their packet-ins are only forwarded until the rule is in place,
+        # optionally confirmed early by a barrier reply.
+        self.pending_installs = {}
+        self.pending_install_ttl = 1.0
+        self.confirm_installs_with_barrier = False
+        # Console output goes through a queue drained by a native thread, per-packet details are
+        # debug records and event_counts is summarized once per stats epoch instead
+        self.log_handler = async_logging.install()
+        self.event_counts = {}
+        # Prometheus text endpoint on http://metrics_host:metrics_port/metrics, served by a hub thread.
+        # Off unless enabled in the [metrics] section of the config file.
+        self.metrics_enabled = CONF.metrics.enabled
+        self.metrics_host = CONF.metrics.host
+        self.metrics_port = CONF.metrics.port
+        self.http_routes = {'/metrics': lambda: (CONTENT_TYPE, self.registry.render()),
+                            '/latency': lambda: ('text/plain', self.latency_report())}
+        # Per-stage packet-in latency histograms, off by default: when disabled the handler only
+        # pays for an attribute test per stage
+        self.latency = StageLatency(enabled=CONF.metrics.latency_enabled)
+        self.registry = MetricsRegistry()
+        self._register_metrics()
+        self.metrics_thread = hub.spawn(self._serve_metrics)
+
+    def _register_metrics(self):
+        registry = self.registry
+        self.packet_in_counter = registry.counter('controller_packet_in_total', 'Packet-ins received')
+        self.flow_mod_counter = registry.counter('controller_flow_mods_total', 'Flow-mods sent', ('command',))
+        self.stats_rtt = registry.histogram('controller_stats_round_trip_seconds', 'Stats request to reply time',
+                                            exponential_buckets(0.001, 2, 14), ('kind',))
+        self.path_time = registry.histogram('controller_path_computation_seconds', 'Path or next hop computation time',
+                                            exponential_buckets(0.00001, 2, 16))
+        registry.gauge('controller_switches', 'Connected datapaths', function=lambda: len(self.datapaths))
+        registry.gauge('controller_links', 'Inter-switch links (one per direction)', function=lambda: self.net.number_of_edges())
+        registry.gauge('controller_hosts', 'Known hosts', function=lambda: len(self.hosts))
+        registry.gauge('controller_flow_routes', 'Tracked TCP routes', function=lambda: len(self.flow_routes))
+        registry.gauge('controller_pending_installs', 'TCP rules waiting to be applied', function=lambda: len(self.pending_installs))
+        registry.gauge('controller_log_records_dropped', 'Log records dropped since the last epoch',
+                       function=lambda: self.log_handler.dropped)
+        registry.gauge('controller_link_delta_bytes', 'rx+tx bytes on the link port between the last two port stats',
+                       ('src', 'dst'), function=lambda: self._link_delta_samples(False))
+        registry.gauge('controller_link_utilization', 'tx bit/s on the link port over its capacity (0-1), as used for link weights',
+                       ('src', 'dst'), function=lambda: self._link_delta_samples(True))
+
+    def _link_delta_samples(self, utilization):
+        samples = {}
+        for (dpid, port_no), neighbor in self.port_to_neighbor.items():
+            if utilization:
+                # Same smoothed tx utilization as calculate_rates, one direction of a full-duplex link
+                value = self.utilization.get(dpid, {}).get(port_no)
+                if value is None:
+                    continue
+                value = value[1]
+            else:
+                value = self.deltas.get(dpid, {}).get(port_no)
+                if value is None:
+                    continue
+            samples[('%016x' % dpid, '%016x' % neighbor)] = value
+        return samples
+
+    def _serve_metrics(self):
+        if not self.metrics_enabled:
+            return
+        server = hub.StreamServer((self.metrics_host, self.metrics_port),
+                                  lambda sock, address: serve_connection(sock, self.http_routes))
+        self.logger.info('metrics on http://%s:%d/metrics', self.metrics_host, self.metrics_port)
+        server.serve_forever()
 
     @set_ev_cls(ofp_event.EventOFPSwitchFeatures, CONFIG_DISPATCHER)
     def switch_features_handler(self, ev):
         datapath = ev.msg.datapath
+        parser = datapath.ofproto_parser
+        self._install_table_miss(datapath)
+        if self.packet_in_protection:
+            # The meter is only used once the switch says it supports pkt/s drop bands
+            datapath.send_msg(parser.OFPMeterFeaturesStatsRequest(datapath, 0))
+
+    def _install_table_miss(self, datapath, meter_id=None):
         ofproto = datapath.ofproto
         parser = datapath.ofproto_parser
         inst = [parser.OFPInstructionActions(ofproto.OFPIT_APPLY_ACTIONS, [parser.OFPActionOutput(ofproto.OFPP_CONTROLLER, ofproto.OFPCML_NO_BUFFER)])]
+        if meter_id is not None:
+            inst.insert(0, parser.OFPInstructionMeter(meter_id, ofproto.OFPIT_METER))
         mod = parser.OFPFlowMod(datapath=datapath, priority=0, match=parser.OFPMatch(), instructions=inst)
         datapath.send_msg(mod)
 
+    @set_ev_cls(ofp_event.EventOFPMeterFeaturesStatsReply, MAIN_DISPATCHER)
+    def _meter_features_reply_handler(self, ev):
+        datapath = ev.msg.datapath
+        ofproto = datapath.ofproto
+        parser = datapath.ofproto_parser
+        for features in ev.msg.body:
+            if features.max_meter < PACKET_IN_METER_ID or not features.band_types & (1 << ofproto.OFPMBT_DROP) \
+                    or not features.capabilities & ofproto.OFPMF_PKTPS:
+                self.logger.info('datapath %016x: no pkt/s meters, packet-ins limited by the controller only', datapath.id)
+                continue
+            command = ofproto.OFPMC_MODIFY if datapath.id in self.packet_in_metered else ofproto.OFPMC_ADD
+            bands = [parser.OFPMeterBandDrop(rate=self.packet_in_rate, burst_size=self.packet_in_burst)]
+            datapath.send_msg(parser.OFPMeterMod(datapath, command=command, flags=ofproto.OFPMF_PKTPS | ofproto.OFPMF_BURST,
+                                                 meter_id=PACKET_IN_METER_ID, bands=bands))
+            self._install_table_miss(datapath, PACKET_IN_METER_ID)
+            self.packet_in_metered.add(datapath.id)
+
+    def _admit_packet_in(self, msg):
+        # Returns False when the packet-in was shed
+        dpid = msg.datapath.id
+        bucket = self.packet_in_buckets.get(dpid)
+        if bucket is None:
+            bucket = self.packet_in_buckets[dpid] = TokenBucket(self.packet_in_rate, self.packet_in_burst)
+        if bucket.consume():
+            self.packet_in_admitted[dpid] = self.packet_in_admitted.get(dpid, 0) + 1
+            return True
+        self.packet_in_shed[dpid] = self.packet_in_shed.get(dpid, 0) + 1
+        if self.packet_in_shed_policy == 'flood':
+            datapath = msg.datapath
+            ofproto = datapath.ofproto
+            parser = datapath.ofproto_parser
+            out = parser.OFPPacketOut(datapath=datapath, buffer_id=msg.buffer_id, in_port=msg.match['in_port'],
+                                      actions=[parser.OFPActionOutput(ofproto.OFPP_FLOOD)], data=msg.data)
+            datapath.send_msg(out)
+        return False
+
     @set_ev_cls(ofp_event.EventOFPStateChange, [MAIN_DISPATCHER, DEAD_DISPATCHER])
     def _state_change_handler(self, ev):
         datapath = ev.datapath
@@ -41,11 +274,94 @@ class EnhancedHopByHopSwitch(simple_switch_13.SimpleSwitch13):
                 self.logger.debug('register datapath: %016x', datapath.id)
                 self.datapaths[datapath.id] = datapath
                 self._id_switch_translator()
+                self._request_port_desc(datapath)
+                self.poll_scheduler.add(datapath.id)
         elif ev.state == DEAD_DISPATCHER:
             if datapath.id in self.datapaths:
                 self.logger.debug('unregister datapath: %016x', datapath.id)
                 del self.datapaths[datapath.id]
                 self._id_switch_translator()
+                self.poll_scheduler.remove(datapath.id)
+                self.packet_in_buckets.pop(datapath.id, None)
+                self.packet_in_metered.discard(datapath.id)
+                # A reconnecting switch has lost its groups and rules, install them again from scratch
+                for key in [key for key in self.ecmp_groups if key[0] == datapath.id]:
+                    del self.ecmp_groups[key]
+                for key in [key for key in self.ecmp_rules if key[0] == datapath.id]:
+                    del self.ecmp_rules[key]
+                self.port_history.drop_group(datapath.id)
+                self.flow_history.drop_group(datapath.id)
+
+    @set_ev_cls(event.EventSwitchEnter)
+    def _switch_enter_handler(self, ev):
+        self.net.add_node(ev.switch.dp.id)
+        self.next_hop_table_dirty = True
+
+    @set_ev_cls(event.EventSwitchLeave)
+    def _switch_leave_handler(self, ev):
+        if ev.switch.dp.id in self.net:
+            for u, _, data in self.net.out_edges(ev.switch.dp.id, data=True):
+                self.port_to_neighbor.pop((u, data['port']), None)
+            for u, _, data in self.net.in_edges(ev.switch.dp.id, data=True):
+                self.port_to_neighbor.pop((u, data['port']), None)
+            self.net.remove_node(ev.switch.dp.id)
+            self.next_hop_table_dirty = True
+
+    @set_ev_cls(event.EventLinkAdd)
+    def _link_add_handler(self, ev):
+        link = ev.link
+        self.net.add_edge(link.src.dpid, link.dst.dpid, port=link.src.port_no, weight=self._link_weight(link.src.dpid, link.src.port_no))
+        self.port_to_neighbor[link.src.dpid, link.src.port_no] = link.dst.dpid
+        self.next_hop_table_dirty = True
+
+    @set_ev_cls(event.EventLinkDelete)
+    def _link_delete_handler(self, ev):
+        link = ev.link
+        # Only drop the edge if it still refers to the port of the deleted link
+        edge = self.net.get_edge_data(link.src.dpid, link.dst.dpid)
+        if edge is not None and edge['port'] == link.src.port_no:
+            self.net.remove_edge(link.src.dpid, link.dst.dpid)
+            self.port_to_neighbor.pop((link.src.dpid, link.src.port_no), None)
+            self.next_hop_table_dirty = True
+
+    @set_ev_cls(event.EventHostAdd)
+    def _host_add_handler(self, ev):
+        self.hosts.add(ev.host)
+
+    @set_ev_cls(event.EventHostMove)
+    def _host_move_handler(self, ev):
+        self.hosts.add(ev.dst)
+
+    @set_ev_cls(event.EventHostDelete)
+    def _host_delete_handler(self, ev):
+        self.hosts.delete(ev.host)
+        self._check_arp_responder_flows()
+
+    def _request_port_desc(self, datapath):
+        parser = datapath.ofproto_parser
+        datapath.send_msg(parser.OFPPortDescStatsRequest(datapath, 0))
+
+    @set_ev_cls(ofp_event.EventOFPPortDescStatsReply, MAIN_DISPATCHER)
+    def _port_desc_stats_reply_handler(self, ev):
+        capacity = self.port_capacity.setdefault(ev.msg.datapath.id, {})
+        for port in ev.msg.body:
+            # curr_speed is expressed in kbit/s
+            capacity[port.port_no] = port.curr_speed * 1000
+
+    @set_ev_cls(ofp_event.EventOFPPortStatus, MAIN_DISPATCHER)
+    def _port_status_handler(self, ev):
+        port = ev.msg.desc
+        self.port_capacity.setdefault(ev.msg.datapath.id, {})[port.port_no] = port.curr_speed * 1000
+
+    def _link_weight(self, switch, port):
+        _, tx_utilization = self.utilization.get(switch, {}).get(port, (0, 0))
+        return self.link_hop_cost + tx_utilization
+
+    def _update_link_weights(self, switch):
+        if switch not in self.net:
+            return
+        for _, _, data in self.net.out_edges(switch, data=True):
+            data['weight'] = self._link_weight(switch, data['port'])
 
     def _id_switch_translator(self):
         self.switches = {}
@@ -54,73 +370,313 @@ class EnhancedHopByHopSwitch(simple_switch_13.SimpleSwitch13):
             self.switches[ids[i]] = i
     
     def _monitor(self):
-        sleep_timer = 10
+        next_epoch = time.time() + self.epoch_interval
         while True:
-            hub.sleep(sleep_timer)
-            for dp in self.datapaths.values():
-                self._request_stats(dp)
+            wait = self.poll_scheduler.tick()
+            now = time.time()
+            if now >= next_epoch:
+                self._end_stats_epoch()
+                next_epoch = now + self.epoch_interval
+            hub.sleep(min(wait, next_epoch - now))
+
+    def _poll_datapath(self, dpid):
+        datapath = self.datapaths.get(dpid)
+        if datapath is None:
+            return ()
+        return self._request_stats(datapath)
 
     def _request_stats(self, datapath):
         ofproto = datapath.ofproto
         parser = datapath.ofproto_parser
-        req = parser.OFPFlowStatsRequest(datapath)
+        req = parser.OFPFlowStatsRequest(datapath, 0, ofproto.OFPTT_ALL, ofproto.OFPP_ANY, ofproto.OFPG_ANY,
+                                         FLOW_COOKIE, 0xffffffffffffffff, parser.OFPMatch())
         datapath.send_msg(req)
         req = parser.OFPPortStatsRequest(datapath, 0, ofproto.OFPP_ANY)
         datapath.send_msg(req)
+        # Kinds of reply the poll scheduler waits for before polling this switch again
+        return ('port', 'flow')
 
     @set_ev_cls(ofp_event.EventOFPPacketIn, MAIN_DISPATCHER)
     def _packet_in_handler(self, ev):
-        msg = ev.msg
+        if not self.latency.enabled:
+            self._handle_packet_in(ev.msg, None)
+            return
+        stamps = [('start', self.latency.clock())]
+        event_type = self._handle_packet_in(ev.msg, stamps)
+        self.latency.record_stages(event_type or 'dropped', stamps)
+
+    def _handle_packet_in(self, msg, stamps):
+        # Returns the event type ('tcp', 'icmp', 'arp', 'pending') or None when nothing was sent.
+        # stamps collects (stage, clock) pairs when stage latencies are measured.
         datapath = msg.datapath
         ofproto = datapath.ofproto
         parser = datapath.ofproto_parser
         in_port = msg.match['in_port']
 
-        pkt = packet.Packet(msg.data)
-        eth = pkt.get_protocol(ethernet.ethernet)    
+        if self.packet_in_protection and not self._admit_packet_in(msg):
+            return None
 
-        if eth.ethertype == ether_types.ETH_TYPE_ARP:
-            self.proxy_arp(msg)
-            return
+        self._count('packet_in')
+        self.packet_in_counter.inc()
+        headers = parse_headers(msg.data)
+        if stamps is not None:
+            stamps.append(('parse', self.latency.clock()))
+        if headers is None:
+            return None
+        ethertype, destination_mac, source_mac, ip_src, ip_dst, ip_proto, l4_src, l4_dst = headers
 
-        if eth.ethertype != ether_types.ETH_TYPE_IP:
-            return
+        if ethertype == ether_types.ETH_TYPE_ARP:
+            self.proxy_arp(msg, headers)
+            if stamps is not None:
+                stamps.append(('arp_reply', self.latency.clock()))
+            return 'arp'
+
+        if ethertype != ether_types.ETH_TYPE_IP or ip_src is None:
+            return None
+
+        pending_key = None
+        if ip_proto == inet.IPPROTO_TCP and l4_src is not None:
+            pending_key = (datapath.id, destination_mac, ip_src, ip_dst, l4_src, l4_dst)
+            pending = self.pending_installs.get(pending_key)
+            if pending is not None:
+                if pending[0] > clock():
+                    self._count('pending_forwarded')
+                    actions = [parser.OFPActionOutput(pending[1])]
+                    out = parser.OFPPacketOut(datapath=datapath, buffer_id=msg.buffer_id, in_port=in_port, actions=actions, data=msg.data)
+                    datapath.send_msg(out)
+                    if stamps is not None:
+                        stamps.append(('send', self.latency.clock()))
+                    return 'pending'
+                del self.pending_installs[pending_key]
 
-        destination_mac = eth.dst
         (dst_dpid, dst_port) = self.find_destination_switch(destination_mac)
+        if stamps is not None:
+            stamps.append(('lookup', self.latency.clock()))
 
         if dst_dpid is None:
-            return
+            self._count('unknown_destination')
+            return None
 
         if dst_dpid == datapath.id:
+            path = [datapath.id]
             output_port = dst_port
+        elif self.install_full_path:
+            started = time.perf_counter()
+            path = self.find_path_to_destination(datapath.id, dst_dpid)
+            self.path_time.observe(time.perf_counter() - started)
+            if path is None:
+                self._count('no_path')
+                return None
+            output_port = self.net[path[0]][path[1]]['port']
         else:
+            path = [datapath.id]
+            started = time.perf_counter()
             output_port = self.find_next_hop_to_destination(datapath.id, dst_dpid)
-        
-        ip = pkt.get_protocol(ipv4.ipv4)
-        
-        if ip.proto == 1:
+            self.path_time.observe(time.perf_counter() - started)
+            if output_port is None:
+                self._count('no_path')
+                return None
+        hops = {u: self.net[u][v]['port'] for u, v in zip(path, path[1:])}
+        hops[path[-1]] = dst_port if path[-1] == dst_dpid else output_port
+        if stamps is not None:
+            stamps.append(('path', self.latency.clock()))
+
+        self.hosts.learn_ip(source_mac, ip_src)
+
+        if ip_proto == inet.IPPROTO_ICMP:
             match = parser.OFPMatch(eth_dst=destination_mac, eth_type=ether.ETH_TYPE_IP, ip_proto=inet.IPPROTO_ICMP)
-            priority = 10
-        elif ip.proto == 6:
-            tcpinfo = pkt.get_protocol(tcp.tcp)
-            if dst_dpid != datapath.id:
-                print(f"\nMatching for {ip.src} {ip.dst} {tcpinfo.src_port} {tcpinfo.dst_port}")
-                print(f"Datapath n{datapath.id} output on port n.{output_port} towards Datapath n.{dst_dpid}")
-                self.periodic_print_deltas(datapath.id)
-            priority = 20
-            match = parser.OFPMatch(eth_dst=destination_mac, eth_type=ether.ETH_TYPE_IP, ip_proto=inet.IPPROTO_TCP, ipv4_src=str(ip.src), ipv4_dst=str(ip.dst), tcp_src=tcpinfo.src_port, tcp_dst=tcpinfo.dst_port)
-            
+            priority = ICMP_FLOW_PRIORITY
+            transit_match, transit_priority = match, priority
+            self._count('icmp_rule')
+            event_type = 'icmp'
+        elif ip_proto == inet.IPPROTO_TCP and l4_src is not None:
+            self.logger.debug('tcp %s:%s -> %s:%s at %016x out port %s towards %016x', ip_src, l4_src, ip_dst, l4_dst,
+                              datapath.id, output_port, dst_dpid)
+            self._count('tcp_rule')
+            ingress = (datapath.id, in_port) not in self.port_to_neighbor
+            granularity = 'mac' if self.hybrid_granularity and not ingress else self.flow_granularity
+            transit_granularity = 'mac' if self.hybrid_granularity else self.flow_granularity
+            match_fields = self._tcp_match_fields(granularity, destination_mac, ip_src, ip_dst, l4_src, l4_dst)
+            priority = GRANULARITY_PRIORITY[granularity]
+            match = parser.OFPMatch(**match_fields)
+            transit_priority = GRANULARITY_PRIORITY[transit_granularity]
+            transit_match = parser.OFPMatch(**self._tcp_match_fields(transit_granularity, destination_mac, ip_src, ip_dst, l4_src, l4_dst))
+            # Routes are tracked at the ingress granularity so transit packet-ins extend the same route
+            route_fields = self._tcp_match_fields(self.flow_granularity, destination_mac, ip_src, ip_dst, l4_src, l4_dst)
+            self._record_flow_route(self.flow_key(route_fields), route_fields, GRANULARITY_PRIORITY[self.flow_granularity],
+                                    datapath.id, in_port, hops, dst_dpid, dst_port)
+            event_type = 'tcp'
+        else:
+            return None
+        if stamps is not None:
+            stamps.append(('match', self.latency.clock()))
+
         assert msg.buffer_id == ofproto.OFP_NO_BUFFER
 
+        # Rest of the path first, egress switch first, so the packet never outruns its rules
+        for dpid in reversed(path[1:]):
+            if dpid in self.datapaths:
+                self._send_flow_mod(self.datapaths[dpid], transit_priority, transit_match, hops[dpid], cookie=FLOW_COOKIE)
 
         actions = [parser.OFPActionOutput(output_port)]
         out = parser.OFPPacketOut(datapath=datapath, buffer_id=msg.buffer_id, in_port=in_port, actions=actions, data=msg.data)
         datapath.send_msg(out)
 
+        self._send_flow_mod(datapath, priority, match, output_port, cookie=FLOW_COOKIE, buffer_id=msg.buffer_id)
+
+        if pending_key is not None:
+            self._add_pending_install(pending_key, output_port)
+        if stamps is not None:
+            stamps.append(('send', self.latency.clock()))
+        return event_type
+
+    def latency_report(self):
+        """
+        Per-stage packet-in latency percentiles, as a table. Also served on /latency.
+        """
+        return self.latency.format()
+
+    def _count(self, name):
+        self.event_counts[name] = self.event_counts.get(name, 0) + 1
+
+    def _add_pending_install(self, key, output_port):
+        pending = (clock() + self.pending_install_ttl, output_port)
+        self.pending_installs[key] = pending
+        if self.confirm_installs_with_barrier:
+            def confirmed():
+                if self.pending_installs.get(key) is pending:
+                    del self.pending_installs[key]
+            self._after_barriers([key[0]], confirmed)
+
+    def _expire_pending_installs(self):
+        now = clock()
+        for key in [key for key, pending in self.pending_installs.items() if pending[0] <= now]:
+            del self.pending_installs[key]
+
+    def _tcp_match_fields(self, granularity, destination_mac, ip_src, ip_dst, tcp_src, tcp_dst):
+        fields = dict(eth_dst=destination_mac, eth_type=ether.ETH_TYPE_IP)
+        if granularity in ('ip_pair', 'five_tuple'):
+            fields.update(ipv4_src=ip_src, ipv4_dst=ip_dst)
+        if granularity == 'five_tuple':
+            fields.update(ip_proto=inet.IPPROTO_TCP, tcp_src=tcp_src, tcp_dst=tcp_dst)
+        return fields
+
+    def _send_flow_mod(self, datapath, priority, match, output_port, cookie=0, buffer_id=None):
+        ofproto = datapath.ofproto
+        parser = datapath.ofproto_parser
+        if buffer_id is None:
+            buffer_id = ofproto.OFP_NO_BUFFER
         inst = [parser.OFPInstructionActions(ofproto.OFPIT_APPLY_ACTIONS, [parser.OFPActionOutput(output_port)])]
-        mod = parser.OFPFlowMod(datapath=datapath, priority=priority, match=match, instructions=inst, buffer_id=msg.buffer_id)
+        mod = parser.OFPFlowMod(datapath=datapath, cookie=cookie, priority=priority, match=match, instructions=inst, buffer_id=buffer_id)
+        datapath.send_msg(mod)
+        self.flow_mod_counter.inc(labels=('add',))
+
+    def _delete_flow(self, datapath, priority, match):
+        ofproto = datapath.ofproto
+        parser = datapath.ofproto_parser
+        mod = parser.OFPFlowMod(datapath=datapath, command=ofproto.OFPFC_DELETE_STRICT, priority=priority, match=match,
+                                out_port=ofproto.OFPP_ANY, out_group=ofproto.OFPG_ANY)
         datapath.send_msg(mod)
+        self.flow_mod_counter.inc(labels=('delete',))
+
+    def _record_flow_route(self, key, match_fields, priority, switch, in_port, hops, dst_dpid, dst_port):
+        # A packet-in from a host-facing port starts a new route
+        if (switch, in_port) not in self.port_to_neighbor or key not in self.flow_routes:
+            self.flow_routes[key] = {'ingress': switch, 'egress': dst_dpid, 'dst_port': dst_port,
+                                     'match': match_fields, 'priority': priority, 'hops': {}}
+        self.flow_routes[key]['hops'].update(hops)
+
+    def _route_path(self, route):
+        path = [route['ingress']]
+        while path[-1] != route['egress']:
+            neighbor = self.port_to_neighbor.get((path[-1], route['hops'].get(path[-1])))
+            if neighbor is None or neighbor in path:
+                return None
+            path.append(neighbor)
+        return path
+
+    @set_ev_cls(ofp_event.EventOFPFlowStatsReply, MAIN_DISPATCHER)
+    def _flow_stats_reply_handler(self, ev):
+        msg = ev.msg
+        switch_id = msg.datapath.id
+        samples = self.flow_samples.setdefault(switch_id, {})
+        rates = self.flow_rates.setdefault(switch_id, {})
+        seen = self._flow_reply_seen.setdefault(switch_id, set())
+        rule_counts = self._rule_count_parts.setdefault(switch_id, {})
+        alpha = self.ewma_alpha
+        sampled = clock()
+        for stat in msg.body:
+            rule_class = PRIORITY_RULE_CLASS.get(stat.priority)
+            if rule_class is None:
+                continue
+            rule_counts[rule_class] = rule_counts.get(rule_class, 0) + 1
+            if rule_class == 'icmp':
+                continue
+            key = self.flow_key(stat.match)
+            seen.add(key)
+            duration = stat.duration_sec + stat.duration_nsec / 1e9
+            self.flow_history.append((switch_id, key), sampled, (stat.byte_count, stat.packet_count))
+            previous = samples.get(key)
+            samples[key] = (stat.byte_count, duration)
+            if previous is None:
+                # First sighting: the lifetime average is the best estimate available
+                if duration > 0:
+                    rates[key] = (stat.byte_count * 8 / duration, stat.byte_count)
+                continue
+            interval = duration - previous[1]
+            if interval <= 0 or stat.byte_count < previous[0]:
+                continue
+            rate = (stat.byte_count - previous[0]) * 8 / interval
+            if key in rates:
+                rate = alpha * rate + (1 - alpha) * rates[key][0]
+            rates[key] = (rate, stat.byte_count)
+        if msg.flags & msg.datapath.ofproto.OFPMPF_REPLY_MORE:
+            return
+        # Last part of the reply: rules that are no longer listed expired or were removed
+        for key in [key for key in samples if key not in seen]:
+            del samples[key]
+            rates.pop(key, None)
+            self.flow_history.drop((switch_id, key))
+            route = self.flow_routes.get(key)
+            if route is not None and route['ingress'] == switch_id:
+                del self.flow_routes[key]
+        self._flow_reply_seen[switch_id] = set()
+        self.rule_counts[switch_id] = rule_counts
+        self._rule_count_parts[switch_id] = {}
+        self._observe_stats_rtt(switch_id, 'flow')
+        self.poll_scheduler.reply(switch_id, 'flow')
+
+    def flow_key(self, match):
+        # Works on an OFPMatch as well as on a dict of match fields
+        return tuple(match.get(field) for field in FLOW_KEY_FIELDS)
+
+    def is_elephant(self, rate, byte_count):
+        return rate >= self.elephant_rate_bps and byte_count >= self.elephant_min_bytes
+
+    def aggregate_flow_rates(self):
+        # A flow crossing several switches is reported once, with its highest rate
+        flows = {}
+        for rates in self.flow_rates.values():
+            for key, (rate, byte_count) in rates.items():
+                if key not in flows or rate > flows[key][0]:
+                    flows[key] = (rate, byte_count)
+        return flows
+
+    def top_flows(self, n=None):
+        """
+        Returns the n fastest flows as (rate_bps, byte_count, key, elephant), fastest first.
+        """
+        flows = self.aggregate_flow_rates()
+        top = heapq.nlargest(n or self.top_flows_count, flows.items(), key=lambda item: item[1][0])
+        return [(rate, byte_count, key, self.is_elephant(rate, byte_count)) for key, (rate, byte_count) in top]
+
+    def elephant_flows(self):
+        elephants = set()
+        for rates in self.flow_rates.values():
+            for key, (rate, byte_count) in rates.items():
+                if self.is_elephant(rate, byte_count):
+                    elephants.add(key)
+        return elephants
 
     @set_ev_cls(ofp_event.EventOFPPortStatsReply, MAIN_DISPATCHER)
     def _port_stats_reply_handler(self, ev):
@@ -130,9 +686,228 @@ class EnhancedHopByHopSwitch(simple_switch_13.SimpleSwitch13):
         if switch_id in self.metrics:
             self.calculate_deltas(switch_id, port_traffic)
         self.metrics[switch_id] = port_traffic
+        max_utilization, max_change = self.calculate_rates(switch_id, body, time.time())
+        self._update_link_weights(switch_id)
+        self._observe_stats_rtt(switch_id, 'port')
+        self.poll_scheduler.reply(switch_id, 'port')
+        self.poll_scheduler.report_activity(switch_id, max_utilization >= self.hot_utilization or
+                                            max_change >= self.utilization_change_threshold)
         # self.periodic_print(switch_id)
         # self.periodic_print_deltas(switch_id)
 
+    def _observe_stats_rtt(self, switch_id, kind):
+        rtt = self.poll_scheduler.round_trip(switch_id)
+        if rtt is not None:
+            self.stats_rtt.observe(rtt, labels=(kind,))
+
+    def _end_stats_epoch(self):
+        self.stats_epoch += 1
+        if self.use_next_hop_table:
+            self._rebuild_next_hop_table()
+        self._expire_pending_installs()
+        if self.rebalance_enabled:
+            self.rebalance()
+        if self.ecmp_enabled:
+            self.update_ecmp_groups()
+        for rate, byte_count, key, elephant in self.top_flows():
+            self.logger.debug('flow %s: %.0f bit/s %d bytes%s', key, rate, byte_count, ' (elephant)' if elephant else '')
+        for dpid, counts in self.rule_counts.items():
+            self.logger.debug('rules %016x: %d %s', dpid, sum(counts.values()), counts)
+        if self.event_counts:
+            self.logger.info('epoch %d events: %s', self.stats_epoch,
+                             ' '.join('%s=%d' % item for item in sorted(self.event_counts.items())))
+            self.event_counts = {}
+        if self.log_handler.dropped:
+            self.logger.warning('%d log records dropped, log queue full', self.log_handler.dropped)
+            self.log_handler.dropped = 0
+        for dpid, shed in self.packet_in_shed.items():
+            self.logger.info('packet-in %016x: %d admitted %d shed (%s)', dpid, self.packet_in_admitted.get(dpid, 0),
+                             shed, self.packet_in_shed_policy)
+        for dpid, poll in self.poll_scheduler.report().items():
+            self.logger.debug('poll %016x: period %.1fs achieved %s timeouts %d', dpid, poll['period'],
+                              poll['achieved_mean'], poll['timeouts'])
+
+    def _rebuild_next_hop_table(self):
+        table = {}
+        reverse = self.net.reverse(copy=False)
+        for dst in self.net:
+            # Dijkstra on the reversed graph yields a shortest-path tree rooted at dst,
+            # so every switch forwards towards dst along the same tree.
+            for src, path in nx.single_source_dijkstra_path(reverse, dst, weight='weight').items():
+                if src != dst:
+                    table[src, dst] = self.net[src][path[-2]]['port']
+        self.next_hop_table = table
+        self.next_hop_table_epoch = self.stats_epoch
+        self.next_hop_table_time = time.time()
+        self.next_hop_table_dirty = False
+
+    def lookup_next_hop(self, source_id, destination_id):
+        if self.next_hop_table_dirty:
+            self._rebuild_next_hop_table()
+        output_port = self.next_hop_table.get((source_id, destination_id))
+        self.logger.debug('next hop %s -> %s: port %s (table epoch %d, current epoch %d, age %.1fs)',
+                          source_id, destination_id, output_port, self.next_hop_table_epoch,
+                          self.stats_epoch, time.time() - self.next_hop_table_time)
+        return output_port
+
+    def rebalance(self):
+        # Remaining load of every inter-switch link above the threshold, as a fraction of capacity
+        hot = {}
+        for switch, ports in self.utilization.items():
+            for port, (_, tx_utilization) in ports.items():
+                if tx_utilization >= self.rebalance_threshold and (switch, port) in self.port_to_neighbor:
+                    hot[switch, port] = tx_utilization
+        if not hot:
+            return 0
+        rates = self.aggregate_flow_rates()
+        # Moving a flow with no measured rate would not cool any link down
+        candidates = sorted(((rates[key][0], key) for key in self.flow_routes if rates.get(key, (0,))[0] > 0),
+                            reverse=True)
+
+        def weight(u, v, data):
+            # Returning None hides the edge from Dijkstra
+            return None if (u, data['port']) in hot else data['weight']
+        moves = 0
+        for rate, key in candidates:
+            if moves >= self.max_moves_per_epoch or not hot:
+                break
+            route = self.flow_routes[key]
+            old_path = self._route_path(route)
+            if old_path is None:
+                continue
+            crossed = [(u, route['hops'][u]) for u in old_path[:-1] if (u, route['hops'][u]) in hot]
+            if not crossed:
+                continue
+            try:
+                new_path = nx.shortest_path(self.net, route['ingress'], route['egress'], weight=weight)
+            except (nx.NetworkXNoPath, nx.NodeNotFound):
+                continue
+            if new_path == old_path or not self._move_flow(key, route, new_path):
+                continue
+            moves += 1
+            self.logger.info('rebalanced flow %s: %s -> %s', key, old_path, new_path)
+            for link in crossed:
+                capacity = self.port_capacity.get(link[0], {}).get(link[1]) or self.default_link_capacity
+                hot[link] -= rate / capacity
+                if hot[link] < self.rebalance_threshold:
+                    del hot[link]
+        return moves
+
+    def _move_flow(self, key, route, new_path):
+        new_hops = {u: self.net[u][v]['port'] for u, v in zip(new_path, new_path[1:])}
+        new_hops[route['egress']] = route['dst_port']
+        if any(dpid not in self.datapaths for dpid in new_hops) or route['ingress'] not in self.datapaths:
+            return False
+        # Make before break: downstream switches first, egress to ingress, then the ingress once
+        # they confirmed with a barrier, and only then the stale rules of the old path
+        downstream = [dpid for dpid in reversed(new_path[1:]) if route['hops'].get(dpid) != new_hops[dpid]]
+        for dpid in downstream:
+            datapath = self.datapaths[dpid]
+            self._send_flow_mod(datapath, route['priority'], datapath.ofproto_parser.OFPMatch(**route['match']),
+                                new_hops[dpid], cookie=FLOW_COOKIE)
+
+        def switch_ingress():
+            ingress = self.datapaths.get(route['ingress'])
+            if ingress is None:
+                return
+            self._send_flow_mod(ingress, route['priority'], ingress.ofproto_parser.OFPMatch(**route['match']),
+                                new_hops[route['ingress']], cookie=FLOW_COOKIE)
+            for dpid in route['hops']:
+                if dpid not in new_hops and dpid in self.datapaths:
+                    datapath = self.datapaths[dpid]
+                    self._delete_flow(datapath, route['priority'], datapath.ofproto_parser.OFPMatch(**route['match']))
+            route['hops'] = new_hops
+        self._after_barriers(downstream, switch_ingress)
+        return True
+
+    def update_ecmp_groups(self):
+        destinations = {}
+        for host in self.hosts.by_mac.values():
+            destinations.setdefault(host.port.dpid, []).append(host)
+        reverse = self.net.reverse(copy=False)
+        for dst, hosts in destinations.items():
+            if dst not in self.net:
+                continue
+            if dst in self.datapaths:
+                for host in hosts:
+                    self._install_ecmp_rule(self.datapaths[dst], host.mac, ('port', host.port.port_no))
+            group_id = self.ecmp_group_ids.setdefault(dst, len(self.ecmp_group_ids) + 1)
+            hop_count = nx.single_source_shortest_path_length(reverse, dst)
+            for switch, distance in hop_count.items():
+                if switch == dst or switch not in self.datapaths:
+                    continue
+                # Every neighbour one hop closer to dst is an equal-cost next hop
+                ports = sorted(data['port'] for _, neighbor, data in self.net.out_edges(switch, data=True)
+                               if hop_count.get(neighbor) == distance - 1)
+                if not ports:
+                    continue
+                self._install_ecmp_group(self.datapaths[switch], group_id, ports)
+                for host in hosts:
+                    self._install_ecmp_rule(self.datapaths[switch], host.mac, ('group', group_id))
+
+    def _ecmp_bucket_weight(self, switch, port):
+        # Spare capacity quantized to ecmp_weight_steps levels to avoid a group-mod for every small change
+        _, tx_utilization = self.utilization.get(switch, {}).get(port, (0, 0))
+        spare = max(0.0, 1.0 - tx_utilization)
+        return max(1, int(spare * self.ecmp_weight_steps) * (100 // self.ecmp_weight_steps))
+
+    def _install_ecmp_group(self, datapath, group_id, ports):
+        buckets = tuple((port, self._ecmp_bucket_weight(datapath.id, port)) for port in ports)
+        current = self.ecmp_groups.get((datapath.id, group_id))
+        if current == buckets:
+            return
+        ofproto = datapath.ofproto
+        parser = datapath.ofproto_parser
+        of_buckets = [parser.OFPBucket(weight=weight, watch_port=ofproto.OFPP_ANY, watch_group=ofproto.OFPG_ANY,
+                                       actions=[parser.OFPActionOutput(port)]) for port, weight in buckets]
+        command = ofproto.OFPGC_ADD if current is None else ofproto.OFPGC_MODIFY
+        datapath.send_msg(parser.OFPGroupMod(datapath, command, ofproto.OFPGT_SELECT, group_id, of_buckets))
+        self.ecmp_groups[(datapath.id, group_id)] = buckets
+
+    def _install_ecmp_rule(self, datapath, mac, target):
+        if self.ecmp_rules.get((datapath.id, mac)) == target:
+            return
+        ofproto = datapath.ofproto
+        parser = datapath.ofproto_parser
+        kind, value = target
+        action = parser.OFPActionGroup(value) if kind == 'group' else parser.OFPActionOutput(value)
+        inst = [parser.OFPInstructionActions(ofproto.OFPIT_APPLY_ACTIONS, [action])]
+        match = parser.OFPMatch(eth_type=ether.ETH_TYPE_IP, eth_dst=mac)
+        datapath.send_msg(parser.OFPFlowMod(datapath=datapath, priority=ECMP_PRIORITY, match=match, instructions=inst))
+        self.flow_mod_counter.inc(labels=('add',))
+        self.ecmp_rules[(datapath.id, mac)] = target
+
+    def _after_barriers(self, dpids, callback):
+        waiting = set()
+        for dpid in dpids:
+            datapath = self.datapaths[dpid]
+            barrier = datapath.ofproto_parser.OFPBarrierRequest(datapath)
+            datapath.set_xid(barrier)
+            datapath.send_msg(barrier)
+            waiting.add((dpid, barrier.xid))
+        if not waiting:
+            callback()
+            return
+        wait = (time.time(), waiting, callback)
+        self._barrier_waits.append(wait)
+        hub.spawn_after(self.barrier_timeout, self._expire_barrier_wait, wait)
+
+    @set_ev_cls(ofp_event.EventOFPBarrierReply, MAIN_DISPATCHER)
+    def _barrier_reply_handler(self, ev):
+        key = (ev.msg.datapath.id, ev.msg.xid)
+        for wait in list(self._barrier_waits):
+            if key in wait[1]:
+                wait[1].discard(key)
+                if not wait[1]:
+                    self._barrier_waits.remove(wait)
+                    wait[2]()
+
+    def _expire_barrier_wait(self, wait):
+        # A lost barrier reply should not leave a flow half moved forever
+        if wait in self._barrier_waits:
+            self._barrier_waits.remove(wait)
+            wait[2]()
+
     def calculate_deltas(self, switch, new_values):
         old_values = self.metrics.get(switch, {})
         switch_deltas = {port: new_values[port] - old_values.get(port, 0) for port in new_values}
@@ -140,75 +915,309 @@ class EnhancedHopByHopSwitch(simple_switch_13.SimpleSwitch13):
         
            
 
+    def calculate_rates(self, switch, body, received):
+        samples = self.port_samples.setdefault(switch, {})
+        rates = self.port_rates.setdefault(switch, {})
+        utilization = self.utilization.setdefault(switch, {})
+        capacity = self.port_capacity.get(switch, {})
+        alpha = self.ewma_alpha
+        max_utilization = max_change = 0
+        sampled = clock()
+        for stat in body:
+            if stat.duration_sec == DURATION_UNSUPPORTED:
+                duration = received
+            else:
+                duration = stat.duration_sec + stat.duration_nsec / 1e9
+            self.port_history.append((switch, stat.port_no), sampled,
+                                     (stat.rx_bytes, stat.tx_bytes, stat.rx_packets, stat.tx_packets))
+            previous = samples.get(stat.port_no)
+            samples[stat.port_no] = (stat.rx_bytes, stat.tx_bytes, duration)
+            if previous is None:
+                continue
+            interval = duration - previous[2]
+            if interval <= 0 or stat.rx_bytes < previous[0] or stat.tx_bytes < previous[1]:
+                # Counters were reset, this sample becomes the new baseline
+                continue
+            rx_bps = (stat.rx_bytes - previous[0]) * 8 / interval
+            tx_bps = (stat.tx_bytes - previous[1]) * 8 / interval
+            if stat.port_no in rates:
+                old_rx_bps, old_tx_bps = rates[stat.port_no]
+                rx_bps = alpha * rx_bps + (1 - alpha) * old_rx_bps
+                tx_bps = alpha * tx_bps + (1 - alpha) * old_tx_bps
+            rates[stat.port_no] = (rx_bps, tx_bps)
+            link_capacity = capacity.get(stat.port_no) or self.default_link_capacity
+            old_utilization = utilization.get(stat.port_no, (0, 0))
+            utilization[stat.port_no] = (rx_bps / link_capacity, tx_bps / link_capacity)
+            max_utilization = max(max_utilization, *utilization[stat.port_no])
+            max_change = max(max_change, abs(utilization[stat.port_no][0] - old_utilization[0]),
+                             abs(utilization[stat.port_no][1] - old_utilization[1]))
+        return max_utilization, max_change
+
     def periodic_print(self, switch):
-        print("##########################")
-        print("### Metric dict status for Switch {} ###".format(switch))
-        print("##########################")
-        for port, traffic in self.metrics[switch].items():
-            print("Port {}: {}".format(port, traffic))
-        print("\n")
+        for port, traffic in self.metrics.get(switch, {}).items():
+            self.logger.debug('metrics %016x port %s: %s', switch, port, traffic)
 
     def periodic_print_deltas(self, switch):
-        print("----------------------------------------")
-        print("### Deltas dict status for Switch {} ###".format(switch))
-        print("----------------------------------------")
-        for port, delta in self.deltas[switch].items():
+        for port, delta in self.deltas.get(switch, {}).items():
             if port < 10:
-                print("Delta Port {}: {}".format(port, delta))
-        # print("\n")
+                self.logger.debug('deltas %016x port %s: %s', switch, port, delta)
 
-    def proxy_arp(self, msg):
+    def proxy_arp(self, msg, headers):
         datapath = msg.datapath
         ofproto = datapath.ofproto
         parser = datapath.ofproto_parser
         in_port = msg.match['in_port']
 
-        pkt_in = packet.Packet(msg.data)
-        eth_in = pkt_in.get_protocol(ethernet.ethernet)
-        arp_in = pkt_in.get_protocol(arp.arp)
+        _, _, eth_src, arp_src_ip, arp_dst_ip, opcode, arp_src_mac, _ = headers
 
-        if arp_in.opcode != arp.ARP_REQUEST:
+        if opcode != arp.ARP_REQUEST or arp_src_ip is None:
             return
 
-        destination_host_mac = None
-        for host in get_all_host(self):
-            if arp_in.dst_ip in host.ipv4:
-                destination_host_mac = host.mac
-                break
+        self.hosts.learn_ip(arp_src_mac, arp_src_ip)
+        self._check_arp_responder_flows()
 
-        if destination_host_mac is None:
-            return
+        key = (eth_src, arp_src_mac, arp_src_ip, arp_dst_ip)
+        entry = self.arp_replies.get(key)
+        if entry is None:
+            destination_host = self.hosts.lookup_ip(arp_dst_ip)
+            if destination_host is None:
+                return
+            destination_host_mac = destination_host.mac
 
-        pkt_out = packet.Packet()
-        eth_out = ethernet.ethernet(dst=eth_in.src, src=destination_host_mac, ethertype=ether_types.ETH_TYPE_ARP)
-        arp_out = arp.arp(opcode=arp.ARP_REPLY, src_mac=destination_host_mac, src_ip=arp_in.dst_ip, dst_mac=arp_in.src_mac, dst_ip=arp_in.src_ip)
-        pkt_out.add_protocol(eth_out)
-        pkt_out.add_protocol(arp_out)
-        pkt_out.serialize()
+            # Only replies are built with the Ryu packet library
+            pkt_out = packet.Packet()
+            eth_out = ethernet.ethernet(dst=eth_src, src=destination_host_mac, ethertype=ether_types.ETH_TYPE_ARP)
+            arp_out = arp.arp(opcode=arp.ARP_REPLY, src_mac=destination_host_mac, src_ip=arp_dst_ip, dst_mac=arp_src_mac, dst_ip=arp_src_ip)
+            pkt_out.add_protocol(eth_out)
+            pkt_out.add_protocol(arp_out)
+            pkt_out.serialize()
+            entry = self.arp_replies.put(key, destination_host_mac, bytes(pkt_out.data))
 
-        out = parser.OFPPacketOut(datapath=datapath, buffer_id=ofproto.OFP_NO_BUFFER, in_port=ofproto.OFPP_CONTROLLER, actions=[parser.OFPActionOutput(in_port)], data=pkt_out.data)
+        out = parser.OFPPacketOut(datapath=datapath, buffer_id=ofproto.OFP_NO_BUFFER, in_port=ofproto.OFPP_CONTROLLER, actions=[parser.OFPActionOutput(in_port)], data=entry.data)
         datapath.send_msg(out)
+        self._count('arp_reply')
+
+        entry.hits += 1
+        if self.install_arp_responder_flows and entry.hits == self.arp_flow_threshold:
+            self._install_arp_responder_flow(datapath, in_port, key, entry.target_mac)
+
+    def _install_arp_responder_flow(self, datapath, in_port, key, target_mac):
+        ofproto = datapath.ofproto
+        parser = datapath.ofproto_parser
+        eth_src, sender_mac, sender_ip, target_ip = key
+        match = parser.OFPMatch(in_port=in_port, eth_type=ether_types.ETH_TYPE_ARP, eth_src=eth_src, arp_op=arp.ARP_REQUEST,
+                                arp_sha=sender_mac, arp_spa=sender_ip, arp_tpa=target_ip)
+        # Turn the request into the reply in the switch and bounce it back out of the ingress port
+        actions = [parser.OFPActionSetField(eth_dst=eth_src),
+                   parser.OFPActionSetField(eth_src=target_mac),
+                   parser.OFPActionSetField(arp_op=arp.ARP_REPLY),
+                   parser.OFPActionSetField(arp_sha=target_mac),
+                   parser.OFPActionSetField(arp_spa=target_ip),
+                   parser.OFPActionSetField(arp_tha=sender_mac),
+                   parser.OFPActionSetField(arp_tpa=sender_ip),
+                   parser.OFPActionOutput(ofproto.OFPP_IN_PORT)]
+        inst = [parser.OFPInstructionActions(ofproto.OFPIT_APPLY_ACTIONS, actions)]
+        mod = parser.OFPFlowMod(datapath=datapath, cookie=ARP_RESPONDER_COOKIE, priority=ARP_RESPONDER_PRIORITY,
+                                hard_timeout=self.arp_flow_hard_timeout, match=match, instructions=inst)
+        datapath.send_msg(mod)
+        self.flow_mod_counter.inc(labels=('add',))
+        self.arp_responder_switches.add(datapath.id)
+
+    def _check_arp_responder_flows(self):
+        # Responder flows only go stale when an address is withdrawn or reassigned
+        if self.hosts.removals == self.arp_responder_removals:
+            return
+        self.arp_responder_removals = self.hosts.removals
+        for dpid in self.arp_responder_switches:
+            datapath = self.datapaths.get(dpid)
+            if datapath is None:
+                continue
+            ofproto = datapath.ofproto
+            parser = datapath.ofproto_parser
+            mod = parser.OFPFlowMod(datapath=datapath, cookie=ARP_RESPONDER_COOKIE, cookie_mask=0xffffffffffffffff,
+                                    command=ofproto.OFPFC_DELETE, out_port=ofproto.OFPP_ANY, out_group=ofproto.OFPG_ANY,
+                                    match=parser.OFPMatch())
+            datapath.send_msg(mod)
+            self.flow_mod_counter.inc(labels=('delete',))
+        self.arp_responder_switches = set()
 
     def find_destination_switch(self, destination_mac):
-        for host in get_all_host(self):
-            if host.mac == destination_mac:
-                return (host.port.dpid, host.port.port_no)
-        return (None, None)
+        host = self.hosts.lookup_mac(destination_mac)
+        if host is None:
+            return (None, None)
+        return (host.port.dpid, host.port.port_no)
+
+    def find_path_to_destination(self, source_id, destination_id):
+        if self.use_next_hop_table:
+            path = [source_id]
+            while path[-1] != destination_id:
+                neighbor = self.port_to_neighbor.get((path[-1], self.lookup_next_hop(path[-1], destination_id)))
+                if neighbor is None or neighbor in path:
+                    return None
+                path.append(neighbor)
+            return path
+        try:
+            return nx.shortest_path(self.net, source_id, destination_id, weight='weight')
+        except (nx.NetworkXNoPath, nx.NodeNotFound):
+            return None
 
     def find_next_hop_to_destination(self, source_id, destination_id):
-        net = nx.DiGraph()
-        edge_weights =  {}
-        # print("-----------------------------------------------------")
-        # print("Switch SRC|     Switch DST    |    Weight   ")
-        # print("-----------------------------------------------------")
-        for link in get_all_link(self):
-            net.add_edge(link.src.dpid, link.dst.dpid, port=link.src.port_no, weight=self.deltas[link.src.dpid].get(link.src.port_no))
-            edge_weights[link.src.dpid, link.dst.dpid] = self.deltas[link.src.dpid].get(link.src.port_no)
-            nx.set_edge_attributes(net, edge_weights, name='weight')
-            # print(f"\t\t{link.src.dpid}\t\t\t\t{link.dst.dpid}      {self.deltas[link.src.dpid].get(link.src.port_no)}")
-            
-        path = nx.shortest_path(net, source_id, destination_id, weight='weight')
-        for i in range(0, len(path)):
-            print(self.switches[path[i]] + " -> ")
-        first_link = net[path[0]][path[1]]
-        return first_link['port']
\ No newline at end of file
+        if self.use_next_hop_table:
+            return self.lookup_next_hop(source_id, destination_id)
+        try:
+            path = nx.shortest_path(self.net, source_id, destination_id, weight='weight')
+        except (nx.NetworkXNoPath, nx.NodeNotFound):
+            return None
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug('path %s', ' -> '.join(str(self.switches.get(dpid, dpid)) for dpid in path))
+        return self.net[path[0]][path[1]]['port']
+
+
+class TokenBucket(object):
+    """
+    Token bucket refilled at `rate` tokens per second up to `burst` tokens.
+    """
+    __slots__ = ('rate', 'burst', 'tokens', 'stamp', 'clock')
+
+    def __init__(self, rate, burst, clock=clock):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.clock = clock
+        self.stamp = clock()
+
+    def consume(self, tokens=1):
+        now = self.clock()
+        self.tokens = min(self.burst, self.tokens + max(0, now - self.stamp) * self.rate)
+        self.stamp = now
+        if self.tokens < tokens:
+            return False
+        self.tokens -= tokens
+        return True
+
+
+class HostDirectory(object):
+    """
+    Controller-local host index keyed by MAC and by IPv4 address.
+    Host objects come from the topology EventHostAdd/EventHostMove events. The topology app fills
+    host.ipv4 in place after the event is sent, so addresses are also learnt from packet-ins.
+    A packet-in can be seen before the event of its host, its address then waits in `pending`,
+    an LRU bounded by max_pending MACs.
+    """
+    def __init__(self, max_pending=4096):
+        self.by_mac = {}
+        self.by_ip = {}
+        self.ips_by_mac = {}
+        self.pending = {}
+        self.max_pending = max_pending
+        # Bumped only when a host or an address binding goes away
+        self.removals = 0
+        # Called with the IPv4 addresses whose binding went away or moved to another MAC
+        self.withdraw_listeners = []
+
+    def add(self, host):
+        # A moved host keeps the addresses already learnt for its MAC
+        self.by_mac[host.mac] = host
+        self.ips_by_mac.setdefault(host.mac, set())
+        for ip in list(host.ipv4) + list(self.pending.pop(host.mac, ())):
+            self.learn_ip(host.mac, ip)
+
+    def delete(self, host):
+        if self.by_mac.pop(host.mac, None) is None:
+            return
+        withdrawn = []
+        for ip in self.ips_by_mac.pop(host.mac, ()):
+            if self.by_ip.get(ip) == host.mac:
+                del self.by_ip[ip]
+                withdrawn.append(ip)
+        self.removals += 1
+        self._withdraw(withdrawn)
+
+    def learn_ip(self, mac, ip):
+        if mac not in self.by_mac:
+            # Least recently seen MACs are evicted first, dicts keep insertion order
+            ips = self.pending.pop(mac, None)
+            if ips is None:
+                ips = set()
+                if len(self.pending) >= self.max_pending:
+                    del self.pending[next(iter(self.pending))]
+            ips.add(ip)
+            self.pending[mac] = ips
+            return
+        if self.by_ip.get(ip) == mac:
+            return
+        old_mac = self.by_ip.get(ip)
+        self.by_ip[ip] = mac
+        self.ips_by_mac[mac].add(ip)
+        if old_mac is not None:
+            self.ips_by_mac[old_mac].discard(ip)
+            self.removals += 1
+            self._withdraw([ip])
+
+    def _withdraw(self, ips):
+        if ips:
+            for listener in self.withdraw_listeners:
+                listener(ips)
+
+    def lookup_mac(self, mac):
+        return self.by_mac.get(mac)
+
+    def lookup_ip(self, ip):
+        mac = self.by_ip.get(ip)
+        if mac is None:
+            return None
+        return self.by_mac[mac]
+
+    def __len__(self):
+        return len(self.by_mac)
+
+
+class ArpReplyEntry(object):
+    __slots__ = ('target_mac', 'data', 'hits')
+
+    def __init__(self, target_mac, data):
+        self.target_mac = target_mac
+        self.data = data
+        self.hits = 0
+
+
+class ArpReplyCache(object):
+    """
+    Serialized ARP replies keyed by (eth src, sender MAC, sender IP, target IP).
+    A reply only depends on the MAC bound to its target IP, so entries are dropped when the
+    directory withdraws that binding. New hosts and addresses leave the cache and its hit counts alone.
+    """
+    def __init__(self, directory, max_entries=4096):
+        self.directory = directory
+        self.max_entries = max_entries
+        self.entries = {}
+        # target IP -> keys of the entries answering for it
+        self.keys_by_target = {}
+        directory.withdraw_listeners.append(self.invalidate)
+
+    def get(self, key):
+        return self.entries.get(key)
+
+    def put(self, key, target_mac, data):
+        if key not in self.entries and len(self.entries) >= self.max_entries:
+            # Evict the oldest entry, dicts keep insertion order
+            self._discard(next(iter(self.entries)))
+        entry = ArpReplyEntry(target_mac, data)
+        self.entries[key] = entry
+        self.keys_by_target.setdefault(key[3], set()).add(key)
+        return entry
+
+    def invalidate(self, target_ips):
+        for ip in target_ips:
+            for key in self.keys_by_target.pop(ip, ()):
+                del self.entries[key]
+
+    def _discard(self, key):
+        del self.entries[key]
+        keys = self.keys_by_target[key[3]]
+        keys.discard(key)
+        if not keys:
+            del self.keys_by_target[key[3]]
+
+    def __len__(self):
+        return len(self.entries)
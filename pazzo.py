@@ -12,15 +12,25 @@ from ryu.lib.packet.icmpv6 import icmpv6
 from ryu.topology import event
 from ryu.topology.api import get_all_switch, get_all_link, get_switch, get_link
 from ryu.lib import dpid as dpid_lib
+from ryu.lib import hub
 from ryu.controller import dpset
-import copy
+import heapq
+import logging
+import time
 from threading import Lock
+from fastpath import parse_headers, ETH_TYPE_ARP
+import async_logging
+
+LOG = logging.getLogger(__name__)
 
 UP = 1
 DOWN = 0
 
 ETH_ADDRESSES = [0x0802, 0x88CC, 0x8808, 0x8809, 0x0800, 0x86DD, 0x88F7]
 
+# Maximum number of serialized ARP replies kept by SimpleSwitch13
+ARP_REPLY_CACHE_SIZE = 4096
+
 class SimpleSwitch13(app_manager.RyuApp):
     OFP_VERSIONS = [ofproto_v1_3.OFP_VERSION]
 
@@ -31,6 +41,19 @@ class SimpleSwitch13(app_manager.RyuApp):
         # Holds the topology data and structure
         self.topo_shape = TopoStructure()
         self.done = 0
+        # Serialized ARP replies. The target hw address is part of the key, so a reply is never
+        # served after the HostCache entry of the target changes.
+        self.arp_reply_cache = {}
+        # Console output goes through a queue drained by a native thread
+        self.log_handler = async_logging.install()
+        # Protect the paths installed for hosts with fast failover groups, see TopoStructure.install_path()
+        self.fast_failover = True
+        # Repairs after a link went down waiting for their barrier replies: (dpid, xid) -> report, see repair_paths()
+        self.repairs_pending = {}
+        # Seconds to wait for the barrier replies of a repair before reporting it as partial
+        self.repair_timeout = 5.0
+        # Report of the last completed repair
+        self.last_repair = None
 
     @set_ev_cls(ofp_event.EventOFPSwitchFeatures, CONFIG_DISPATCHER)
     def switch_features_handler(self, ev):
@@ -84,32 +107,24 @@ class SimpleSwitch13(app_manager.RyuApp):
     @set_ev_cls(ofp_event.EventOFPPacketIn, MAIN_DISPATCHER)
     def _packet_in_handler(self, ev):
         msg = ev.msg
-        print("#############################################")
         datapath = msg.datapath
         dpid = datapath.id
 
         port = msg.match['in_port']
+        # Only ARP is handled here, everything else is dropped before the full Ryu parser runs
+        headers = parse_headers(msg.data)
+        if headers is None or headers[0] != ETH_TYPE_ARP:
+            return
         pkt = packet.Packet(data=msg.data)
         #self.logger.info("packet-in: %s" % (pkt,))
 
         pkt_eth = pkt.get_protocol(ethernet.ethernet)
-        if pkt_eth:
-
-            dst_mac = pkt_eth.dst
-            eth_type = pkt_eth.ethertype
 
         # This 'if condition' is for learning the ip and mac addresses of hosts as well as .
         pkt_arp = pkt.get_protocol(arp.arp)
         if pkt_arp:
-            print "datapath id: "+str(dpid)
-            print "port: "+str(port)
-            print ("pkt_eth.dst: " + str(pkt_eth.dst))
-            print ("pkt_eth.src: " + str(pkt_eth.src))
-            print ("pkt_arp: " + str(pkt_arp))
-            print ("pkt_arp:src_ip: " + str(pkt_arp.src_ip))
-            print ("pkt_arp:dst_ip: " + str(pkt_arp.dst_ip))
-            print ("pkt_arp:src_mac: " + str(pkt_arp.src_mac))
-            print ("pkt_arp:dst_mac: " + str(pkt_arp.dst_mac))
+            self.logger.debug("arp dpid=%s port=%s eth %s -> %s arp %s/%s -> %s/%s", dpid, port, pkt_eth.src, pkt_eth.dst,
+                              pkt_arp.src_ip, pkt_arp.src_mac, pkt_arp.dst_ip, pkt_arp.dst_mac)
 
             # Destination and source ip address
             d_ip = pkt_arp.dst_ip
@@ -121,26 +136,14 @@ class SimpleSwitch13(app_manager.RyuApp):
 
             in_port = msg.match['in_port']
 
-            print ("Before ip_cache.ip_to_dpid_port: "+str(self.topo_shape.ip_cache.ip_to_dpid_port))
-            # This is where ip address of hosts is learnt.
-            resu = self.topo_shape.ip_cache.get_dpid_for_ip(s_ip)
-            print("resu: "+str(resu))
-            if resu == -1:
-                # If there is no entry for ip s_ip then add one
-                temp_dict = {"connected_host_mac":s_mac, "sw_port_no":in_port,
-                             "sw_port_mac":self.topo_shape.get_hw_address_for_port_of_dpid(in_dpid=dpid, in_port_no=in_port)}
-                self.topo_shape.ip_cache.add_dpid_host(in_dpid=dpid, in_host_ip=s_ip, **temp_dict)
-            else:
-                print("-------------------------------------------")
-                # IF there is such an entry for ip address s_ip then just update the values
-                self.topo_shape.ip_cache.ip_to_dpid_port[dpid][s_ip]["sw_port_no"] = in_port
-                # Updating mac: because a host may get disconnected and new host with same ip but different mac connects
-                self.topo_shape.ip_cache.ip_to_dpid_port[dpid][s_ip]["connected_host_mac"] = s_mac
-                # get_hw_address_for_port_of_dpid(): gets and mac address of a given port id on specific sw or dpid
-                self.topo_shape.ip_cache.ip_to_dpid_port[dpid][s_ip]["sw_port_mac"] = self.topo_shape.get_hw_address_for_port_of_dpid(
-                    in_dpid=dpid, in_port_no=in_port)
+            # This is where ip address of hosts is learnt. The entry for s_ip is added or updated: a host may move
+            # or get disconnected and a new host with same ip but different mac connects.
+            # get_hw_address_for_port_of_dpid(): gets and mac address of a given port id on specific sw or dpid
+            host = self.topo_shape.ip_cache.update_host(
+                in_dpid=dpid, in_ip=s_ip, in_mac=s_mac, in_port_no=in_port,
+                in_port_mac=self.topo_shape.get_hw_address_for_port_of_dpid(in_dpid=dpid, in_port_no=in_port))
 
-            print ("After ip_cache.ip_to_dpid_port: "+str(self.topo_shape.ip_cache.ip_to_dpid_port))
+            self.logger.debug("ip_cache: %s", host)
 
             d_resu = self.topo_shape.ip_cache.get_dpid_for_ip(d_ip)
             if d_resu != -1:
@@ -148,13 +151,12 @@ class SimpleSwitch13(app_manager.RyuApp):
                 # find_shortest_path(): Finds shortest path starting dpid for all nodes.
                 # shortest_path_node: Contains the last node you need to get in order to reach dest from source dpid
                 shortest_path_hubs, shortest_path_node = self.topo_shape.find_shortest_path(s=dpid)
-                print "Shortest Path in ARP packet_in starting dpid: {0}".format(dpid)
-                print("\tNew shortest_path_hubs: {0}"
-                      "\n\tNew shortest_path_node: {1}".format(shortest_path_hubs, shortest_path_node))
+                self.logger.debug("Shortest Path in ARP packet_in starting dpid: %s hubs: %s node: %s",
+                                  dpid, shortest_path_hubs, shortest_path_node)
 
                 # Based on the ip of the destination the dpid of the switch connected to host ip
                 dst_dpid_for_ip = self.topo_shape.ip_cache.get_dpid_for_ip(ip=d_ip)
-                print ("found {0} ip connected to dpid {1}".format(d_ip, dst_dpid_for_ip))
+                self.logger.debug("found %s ip connected to dpid %s", d_ip, dst_dpid_for_ip)
                 if dst_dpid_for_ip != -1 and dpid != dst_dpid_for_ip:
                     temp_dpid_path = self.topo_shape.find_path(s=dpid, d=dst_dpid_for_ip, s_p_n=shortest_path_node)
                     temp_link_path = self.topo_shape.convert_dpid_path_to_links(dpid_list=temp_dpid_path)
@@ -164,8 +166,8 @@ class SimpleSwitch13(app_manager.RyuApp):
 
                     #self.topo_shape.make_path_between_hosts_in_linklist_for_flood(src_ip=s_ip, dst_ip=d_ip, in_link_path=temp_link_path)
                     #self.topo_shape.make_path_between_hosts_in_linklist_for_flood(src_ip=d_ip, dst_ip=s_ip, in_link_path=reverted_temp_link_path)
-                    self.topo_shape.make_path_between_hosts_in_linklist(src_ip=s_ip, dst_ip=d_ip, in_link_path=temp_link_path)
-                    self.topo_shape.make_path_between_hosts_in_linklist(src_ip=d_ip, dst_ip=s_ip, in_link_path=reverted_temp_link_path)
+                    self._install_path(src_ip=s_ip, dst_ip=d_ip, in_link_path=temp_link_path)
+                    self._install_path(src_ip=d_ip, dst_ip=s_ip, in_link_path=reverted_temp_link_path)
 
                 self._handle_arp(datapath=datapath,
                                  port=port,
@@ -176,27 +178,36 @@ class SimpleSwitch13(app_manager.RyuApp):
         # This prints list of hw addresses of the port for given dpid
         #print(str(self.topo_shape.get_hw_addresses_for_dpid(in_dpid=dpid)))
 
+    def _install_path(self, src_ip, dst_ip, in_link_path):
+        return self.topo_shape.install_path(src_ip=src_ip, dst_ip=dst_ip, in_link_path=in_link_path,
+                                            protect=self.fast_failover)
+
     def _handle_arp(self, datapath, port, pkt_ethernet, pkt_arp, target_hw_addr, target_ip_addr):
         # see http://osrg.github.io/ryu-book/en/html/packet_lib.html
         if pkt_arp.opcode != arp.ARP_REQUEST:
             return
-        pkt = packet.Packet()
-        pkt.add_protocol(ethernet.ethernet(ethertype=pkt_ethernet.ethertype,
-                                           dst=pkt_ethernet.src,
-                                           src=target_hw_addr))
-        pkt.add_protocol(arp.arp(opcode=arp.ARP_REPLY,
-                                 src_mac=target_hw_addr,
-                                 src_ip=target_ip_addr,
-                                 dst_mac=pkt_arp.src_mac,
-                                 dst_ip=pkt_arp.src_ip))
-        self._send_packet(datapath, port, pkt)
-
-    def _send_packet(self, datapath, port, pkt):
+        key = (pkt_ethernet.ethertype, pkt_ethernet.src, pkt_arp.src_mac, pkt_arp.src_ip, target_hw_addr, target_ip_addr)
+        data = self.arp_reply_cache.get(key)
+        if data is None:
+            pkt = packet.Packet()
+            pkt.add_protocol(ethernet.ethernet(ethertype=pkt_ethernet.ethertype,
+                                               dst=pkt_ethernet.src,
+                                               src=target_hw_addr))
+            pkt.add_protocol(arp.arp(opcode=arp.ARP_REPLY,
+                                     src_mac=target_hw_addr,
+                                     src_ip=target_ip_addr,
+                                     dst_mac=pkt_arp.src_mac,
+                                     dst_ip=pkt_arp.src_ip))
+            pkt.serialize()
+            data = bytes(pkt.data)
+            if len(self.arp_reply_cache) >= ARP_REPLY_CACHE_SIZE:
+                self.arp_reply_cache.clear()
+            self.arp_reply_cache[key] = data
+        self._send_packet_data(datapath, port, data)
+
+    def _send_packet_data(self, datapath, port, data):
         ofproto = datapath.ofproto
         parser = datapath.ofproto_parser
-        pkt.serialize()
-        self.logger.info("To dpid {0} packet-out {1}".format(datapath.id, pkt))
-        data = pkt.data
         actions = [parser.OFPActionOutput(port=port)]
         out = parser.OFPPacketOut(datapath=datapath,
                                   buffer_id=ofproto.OFP_NO_BUFFER,
@@ -210,8 +221,8 @@ class SimpleSwitch13(app_manager.RyuApp):
     """
     @set_ev_cls(event.EventSwitchEnter)
     def handler_switch_enter(self, ev):
-        self.topo_shape.topo_raw_switches = copy.copy(get_switch(self, None))
-        self.topo_shape.topo_raw_links = copy.copy(get_link(self, None))
+        self.topo_shape.update_switches(get_switch(self, None))
+        self.topo_shape.update_links(get_link(self, None))
 
         self.topo_shape.print_links("EventSwitchEnter")
         self.topo_shape.print_switches("EventSwitchEnter")
@@ -231,8 +242,6 @@ class SimpleSwitch13(app_manager.RyuApp):
     """
     @set_ev_cls(dpset.EventPortModify, MAIN_DISPATCHER)
     def port_modify_handler(self, ev):
-        print ("\t #######################")
-        self.topo_shape.lock.acquire()
         dp = ev.dp
         port_attr = ev.port
         dp_str = dpid_lib.dpid_to_str(dp.id)
@@ -247,56 +256,102 @@ class SimpleSwitch13(app_manager.RyuApp):
                           port_attr.max_speed))
 
         if port_attr.state == 1:
-            tmp_list = []
-            first_removed_link = self.topo_shape.link_with_src_and_port(port_attr.port_no, dp.id)
-            second_removed_link = self.topo_shape.link_with_dst_and_port(port_attr.port_no, dp.id)
-
-            for i, link in enumerate(self.topo_shape.topo_raw_links):
-                if link.src.dpid == dp.id and link.src.port_no == port_attr.port_no:
-                    print "\t Removing link " + str(link) + " with index " + str(i)
-                elif link.dst.dpid == dp.id and link.dst.port_no == port_attr.port_no:
-                    print "\t Removing link " + str(link) + " with index " + str(i)
-                else:
-                    tmp_list.append(link)
-
-            self.topo_shape.topo_raw_links = copy.copy(tmp_list)
+            started = time.time()
+            # Only the topology is updated while holding the lock. Protected paths have already failed over in the
+            # switches, the paths are re-optimized afterwards.
+            with self.topo_shape.lock:
+                removed_links = self.topo_shape.remove_links_at_port(dp.id, port_attr.port_no)
+                affected = self.topo_shape.paths_using_links(removed_links)
 
             self.topo_shape.print_links(" Link Down")
-            print "\t First removed link: " + str(first_removed_link)
-            print "\t Second removed link: " + str(second_removed_link)
-
-            if first_removed_link is not None and second_removed_link is not None:
-                # Find shortest path for source with dpid first_removed_link.src.dpid
-                shortest_path_hubs, shortest_path_node = self.topo_shape.find_shortest_path(first_removed_link.src.dpid)
-                print "\t Shortest Path:"
-                print("\t\tNew shortest_path_hubs: {0}"
-                      "\n\t\tNew shortest_path_node: {1}".format(shortest_path_hubs, shortest_path_node))
-
-                """
-                find_backup_path(): Finds the bakcup path (which contains dpids) for the removed link which is
-                    called first_removed_link based on shortest_path_node that is given to find_backup_path()
-                convert_dpid_path_to_links(): The functions turns the given list of dpid to list of Link objects.
-                revert_link_list(): This reverts the links in the list of objects. This is because all the links in the
-                    topo are double directed edge.
-                """
-                result = self.topo_shape.convert_dpid_path_to_links(self.topo_shape.find_backup_path(
-                    link=first_removed_link, shortest_path_node=shortest_path_node))
-                self.topo_shape.print_input_links(list_links=result)
-                reverted_result = self.topo_shape.revert_link_list(link_list=result)
-                self.topo_shape.print_input_links(list_links=reverted_result)
-                # ToDo: Note that here i assume that each sw has one host connected to it.
-                first_sw = self.topo_shape.get_first_sw_dpid_in_linklist(in_linklist=result)
-                last_sw = self.topo_shape.get_last_sw_dpid_in_linklist(in_linklist=result)
-                first_ip = self.topo_shape.ip_cache.get_ip_addresses_connected_to_dpid(in_dpid=first_sw)[0]
-                last_ip = self.topo_shape.ip_cache.get_ip_addresses_connected_to_dpid(in_dpid=last_sw)[0]
-                self.topo_shape.make_path_between_hosts_in_linklist(src_ip=first_ip, dst_ip=last_ip, in_link_path=result)
-                print ("Second make path")
-                print ("src_ip= {0} dst_ip= {1}".format(last_ip, first_ip))
-                self.topo_shape.print_input_links((reversed(reverted_result)))
-                self.topo_shape.make_path_between_hosts_in_linklist(src_ip=last_ip, dst_ip=first_ip, in_link_path=reverted_result)
+            self.logger.info("Removed links: %s, %d installed paths affected", removed_links, len(affected))
+
+            if affected:
+                hub.spawn(self.repair_paths, affected, started)
         elif port_attr.state == 0:
             self.topo_shape.print_links(" Link Up")
-        self.topo_shape.lock.release()
+
+    def repair_paths(self, paths, started):
+        """
+        Installs a new shortest path, with a new backup when fast_failover is set, for each (src ip, dst ip) in paths.
+        The messages are sent switch by switch, each switch batch followed by a barrier. The time from started to the
+        last barrier reply is logged as the time to repair and kept in last_repair. If a switch disconnects or does not
+        answer within repair_timeout the repair is reported as partial.
+        """
+        with self.topo_shape.lock:
+            repaired = 0
+            self.topo_shape.begin_batch()
+            try:
+                for src_ip, dst_ip in paths:
+                    if self._reroute(src_ip, dst_ip):
+                        repaired += 1
+            finally:
+                barriers = self.topo_shape.flush_batch()
+        report = {'paths': len(paths), 'repaired': repaired, 'switches': len(barriers), 'unconfirmed': 0,
+                  'started': started, 'sent': time.time() - started, 'waiting': set(barriers)}
+        for barrier in barriers:
+            self.repairs_pending[barrier] = report
+        if barriers:
+            hub.spawn_after(self.repair_timeout, self._expire_repair, report)
+        else:
+            self._repair_done(report)
+
+    def _reroute(self, src_ip, dst_ip):
+        src_dpid = self.topo_shape.ip_cache.get_dpid_for_ip(src_ip)
+        dst_dpid = self.topo_shape.ip_cache.get_dpid_for_ip(dst_ip)
+        if src_dpid != -1 and dst_dpid != -1 and src_dpid != dst_dpid:
+            # Cached per source, paths from the same switch share one Dijkstra run
+            _, shortest_path_node = self.topo_shape.find_shortest_path(src_dpid)
+            if dst_dpid in shortest_path_node:
+                link_path = self.topo_shape.convert_dpid_path_to_links(
+                    self.topo_shape.find_path(s=src_dpid, d=dst_dpid, s_p_n=shortest_path_node))
+                if self._install_path(src_ip=src_ip, dst_ip=dst_ip, in_link_path=link_path) is not None:
+                    return True
+        self.logger.warning("Could not reroute %s to %s", src_ip, dst_ip)
+        self.topo_shape.forget_path(src_ip, dst_ip)
+        return False
+
+    @set_ev_cls(ofp_event.EventOFPBarrierReply, MAIN_DISPATCHER)
+    def _barrier_reply_handler(self, ev):
+        msg = ev.msg
+        report = self.repairs_pending.pop((msg.datapath.id, msg.xid), None)
+        if report is not None:
+            report['waiting'].discard((msg.datapath.id, msg.xid))
+            if not report['waiting']:
+                self._repair_done(report)
+
+    @set_ev_cls(ofp_event.EventOFPStateChange, DEAD_DISPATCHER)
+    def _state_change_handler(self, ev):
+        # A disconnected switch never answers its barriers
+        dpid = ev.datapath.id
+        for barrier in [b for b in self.repairs_pending if b[0] == dpid]:
+            self._unconfirmed(barrier)
+
+    def _expire_repair(self, report):
+        for barrier in list(report.get('waiting', ())):
+            self._unconfirmed(barrier)
+
+    def _unconfirmed(self, barrier):
+        report = self.repairs_pending.pop(barrier)
+        report['waiting'].discard(barrier)
+        report['unconfirmed'] += 1
+        if not report['waiting']:
+            self._repair_done(report)
+
+    def _repair_done(self, report):
+        report['time_to_repair'] = time.time() - report['started']
+        report['partial'] = report['unconfirmed'] > 0
+        del report['waiting']
+        self.last_repair = report
+        if report['partial']:
+            self.logger.warning("Link down partially repaired: %d of %d paths rerouted on %d switches, %d switches did "
+                                "not confirm, sent after %.1f ms, gave up after %.1f ms", report['repaired'],
+                                report['paths'], report['switches'], report['unconfirmed'], report['sent'] * 1000,
+                                report['time_to_repair'] * 1000)
+        else:
+            self.logger.info("Link down repaired: %d of %d paths rerouted on %d switches, sent after %.1f ms, "
+                             "time to repair %.1f ms", report['repaired'], report['paths'], report['switches'],
+                             report['sent'] * 1000, report['time_to_repair'] * 1000)
 
         ###################################################################################
         ###################################################################################
@@ -305,15 +360,54 @@ class SimpleSwitch13(app_manager.RyuApp):
 This holds the hosts information and their connection to switches.
 An instance of this class is used in TopoStructure to save the topo info.
 """
+class HostRecord(object):
+    """
+    Where a host with a given ip address is connected: the switch dpid, the switch port number and its hw
+    address, and the host hw address.
+    """
+    __slots__ = ('ip', 'dpid', 'mac', 'sw_port_no', 'sw_port_mac')
+
+    def __init__(self, ip, dpid, mac=None, sw_port_no=None, sw_port_mac=None):
+        self.ip = ip
+        self.dpid = dpid
+        self.mac = mac
+        self.sw_port_no = sw_port_no
+        self.sw_port_mac = sw_port_mac
+
+    def __repr__(self):
+        return "HostRecord(ip=%s, dpid=%s, mac=%s, sw_port_no=%s, sw_port_mac=%s)" % (
+            self.ip, self.dpid, self.mac, self.sw_port_no, self.sw_port_mac)
+
+
 class HostCache(object):
     def __init__(self):
-        self.ip_to_dpid_port = {}
+        # ip -> HostRecord
+        self.hosts = {}
+        # host hw address -> ip
+        self.mac_to_ip = {}
+        # dpid -> {ip: HostRecord} for the hosts connected to that switch
+        self.hosts_by_dpid = {}
+
+    @property
+    def ip_to_dpid_port(self):
+        """
+        The cache as nested dicts {dpid: {ip: {"connected_host_mac", "sw_port_no", "sw_port_mac"}}}, built on
+        every access. Read only.
+        """
+        return dict((dpid, dict((ip, {"connected_host_mac": r.mac, "sw_port_no": r.sw_port_no,
+                                      "sw_port_mac": r.sw_port_mac}) for ip, r in hosts.items()))
+                    for dpid, hosts in self.hosts_by_dpid.items())
 
     def get_hw_address_of_host(self, in_ip):
-        #print("in_ip: "+str(in_ip))
-        t_dpid = self.get_dpid_for_ip(ip=in_ip)
-        #print ("t_dpid: "+str(t_dpid))
-        return self.ip_to_dpid_port[t_dpid][in_ip]["connected_host_mac"]
+        return self.hosts[in_ip].mac
+
+    def get_ip_for_hw_address(self, in_mac):
+        """
+        Returns the ip address of the host with hw address in_mac, or None if it is not known.
+        :param in_mac: Hw address of the host
+        :rtype : str
+        """
+        return self.mac_to_ip.get(in_mac)
 
     def add_dpid_host(self,in_dpid, in_host_ip, **in_dict):
         """
@@ -323,8 +417,43 @@ class HostCache(object):
         :param in_host_ip:
         :param in_dict:
         """
-        self.ip_to_dpid_port.setdefault(in_dpid, {})
-        self.ip_to_dpid_port[in_dpid][in_host_ip]=in_dict
+        self.update_host(in_dpid, in_host_ip, in_dict.get("connected_host_mac"), in_dict.get("sw_port_no"),
+                         in_dict.get("sw_port_mac"))
+
+    def update_host(self, in_dpid, in_ip, in_mac, in_port_no, in_port_mac):
+        """
+        Records that the host with ip address in_ip and hw address in_mac is connected to port in_port_no of switch
+        in_dpid, moving it if it was known somewhere else.
+        :param in_dpid: Datapath id of the switch
+        :param in_ip: Ip address of the host
+        :param in_mac: Hw address of the host
+        :param in_port_no: Port number of the switch the host is connected to
+        :param in_port_mac: Hw address of that port
+        :rtype : HostRecord
+        """
+        record = self.hosts.get(in_ip)
+        if record is None:
+            record = self.hosts[in_ip] = HostRecord(in_ip, in_dpid)
+        elif record.dpid != in_dpid:
+            self._remove_from_dpid(record)
+            record.dpid = in_dpid
+        self.hosts_by_dpid.setdefault(in_dpid, {})[in_ip] = record
+        if record.mac != in_mac:
+            if record.mac is not None and self.mac_to_ip.get(record.mac) == in_ip:
+                del self.mac_to_ip[record.mac]
+            record.mac = in_mac
+        if in_mac is not None:
+            self.mac_to_ip[in_mac] = in_ip
+        record.sw_port_no = in_port_no
+        record.sw_port_mac = in_port_mac
+        return record
+
+    def _remove_from_dpid(self, record):
+        hosts = self.hosts_by_dpid.get(record.dpid)
+        if hosts is not None:
+            hosts.pop(record.ip, None)
+            if not hosts:
+                del self.hosts_by_dpid[record.dpid]
 
     def get_port_num_connected_to_sw(self, in_dpid, in_ip):
         """
@@ -335,10 +464,11 @@ class HostCache(object):
         :param in_ip: Ip address connected to switch with datapath id equal to in_dpid
         :rtype : int
         """
-        if len(self.ip_to_dpid_port[in_dpid][in_ip].keys()) == 0:
+        record = self.hosts.get(in_ip)
+        if record is None or record.dpid != in_dpid or record.sw_port_no is None:
             return -1
         else:
-            return self.ip_to_dpid_port[in_dpid][in_ip]["sw_port_no"]
+            return record.sw_port_no
 
     def get_number_of_hosts_connected_to_dpid(self, in_dpid):
         """
@@ -346,7 +476,7 @@ class HostCache(object):
         :param in_dpid: Datapath id of a switch
         :rtype : int
         """
-        return len(self.ip_to_dpid_port[in_dpid])
+        return len(self.hosts_by_dpid.get(in_dpid, ()))
 
     def get_ip_addresses_connected_to_dpid(self, in_dpid):
         """
@@ -354,7 +484,7 @@ class HostCache(object):
         :param in_dpid: Datapath id
         :rtype : list
         """
-        return self.ip_to_dpid_port[in_dpid].keys()
+        return list(self.hosts_by_dpid.get(in_dpid, ()))
 
     def get_dpid_for_ip(self, ip):
         """
@@ -364,28 +494,79 @@ class HostCache(object):
         :param ip: Ip address of host
         :rtype : int
         """
-        for temp_dpid in self.ip_to_dpid_port.keys():
-            if ip in self.ip_to_dpid_port[temp_dpid].keys():
-                print "\ttemp_dpid for ip : ".format(str(temp_dpid), ip)
-                return temp_dpid
-        return -1
+        record = self.hosts.get(ip)
+        return record.dpid if record is not None else -1
 
     def check_dpid_in_cache(self, in_dpid):
         """
-        Checks if an dpid is in self.ip_to_dpid_port
+        Checks if an dpid has hosts in the cache
         :param in_dpid: Datapath id
         :rtype : bool
         """
-        if in_dpid in self.ip_to_dpid_port.keys():
-            return True
-        else:
-            return False
+        return in_dpid in self.hosts_by_dpid
+
+
+class InstalledPath(object):
+    """
+    A path installed by TopoStructure.install_path(): the switch ports the hosts were connected to and their hw
+    addresses when it was installed, the links of the path and of its backup (empty when not protected), the
+    (dpid, in_port, eth_src, eth_dst) matches of its flows and of those forwarding to a fast failover group, and the
+    TopoStructure.links_version it was computed at.
+    """
+    __slots__ = ('src_ip', 'dst_ip', 'src_port', 'dst_port', 'src_mac', 'dst_mac', 'primary', 'backup', 'protect',
+                 'flows', 'groups', 'links_version')
+
+    def __init__(self, src_ip, dst_ip, src_port, dst_port, src_mac, dst_mac, primary, backup, protect, links_version):
+        self.src_ip = src_ip
+        self.dst_ip = dst_ip
+        self.src_port = src_port
+        self.dst_port = dst_port
+        self.src_mac = src_mac
+        self.dst_mac = dst_mac
+        self.primary = primary
+        self.backup = backup
+        self.protect = protect
+        self.flows = []
+        self.groups = []
+        self.links_version = links_version
+
+
+def _link_key(l):
+    return l.src.dpid, l.src.port_no, l.dst.dpid, l.dst.port_no
+
 
 """
 This class holds the list of links and switches in the topology and it provides some useful functions
 """
 class TopoStructure(object):
     def __init__(self, *args, **kwargs):
+        # Indexes over topo_raw_switches and topo_raw_links, kept up to date by update_switches(),
+        # update_links(), bring_up_link() and remove_links_at_port():
+        # dpid -> switch, (dpid, port_no) -> hw address of the port
+        self._switches_by_dpid = {}
+        self._port_hw_addr = {}
+        # (src dpid, src port, dst dpid, dst port) -> link, src dpid -> outgoing links,
+        # (dpid, port_no) -> link leaving / entering there, (src dpid, dst dpid) -> link
+        self._links_by_key = {}
+        self._links_by_src = {}
+        self._link_by_src_port = {}
+        self._link_by_dst_port = {}
+        self._link_by_pair = {}
+        # find_shortest_path() results per source, dropped whenever the link set changes.
+        self._shortest_path_cache = {}
+        # Incremented whenever the link set changes
+        self.links_version = 0
+        # Paths installed by install_path(): (src ip, dst ip) -> InstalledPath, and the paths using each link
+        # of their primary or backup path: link key -> set of (src ip, dst ip)
+        self.installed_paths = {}
+        self.paths_by_link = {}
+        # Messages held back per dpid between begin_batch() and flush_batch(): dpid -> (datapath, [msg])
+        self._batch = None
+        # Last fast failover group id used per dpid, and the group of each flow of the installed paths:
+        # (dpid, in_port, eth_src, eth_dst) -> [group id, set of the InstalledPath using it]. Only the old and the new
+        # path of a pair share a group, while one replaces the other.
+        self._last_group_id = {}
+        self._failover_groups = {}
         self.topo_raw_switches = []
         self.topo_raw_links = []
         self.topo_links = []
@@ -395,6 +576,117 @@ class TopoStructure(object):
         # Record where each host is connected to.
         self.ip_cache = HostCache()
 
+    @property
+    def topo_raw_switches(self):
+        return self._topo_raw_switches
+
+    @topo_raw_switches.setter
+    def topo_raw_switches(self, switches):
+        self.update_switches(switches)
+
+    @property
+    def topo_raw_links(self):
+        return self._topo_raw_links
+
+    @topo_raw_links.setter
+    def topo_raw_links(self, links):
+        self.update_links(links)
+
+    def update_switches(self, switches):
+        """
+        Replaces the learned switches with `switches`, re-indexing only the dpids whose switch object changed.
+        :param switches: List of switch objects, as returned by get_switch()
+        """
+        new = dict((sw.dp.id, sw) for sw in switches)
+        for dpid in list(self._switches_by_dpid):
+            if dpid not in new:
+                self._unindex_switch(dpid)
+        for dpid, sw in new.items():
+            if self._switches_by_dpid.get(dpid) is not sw:
+                self._unindex_switch(dpid)
+                self._switches_by_dpid[dpid] = sw
+                for p in sw.ports:
+                    self._port_hw_addr[(dpid, p.port_no)] = p.hw_addr
+        self._topo_raw_switches = list(switches)
+
+    def _unindex_switch(self, dpid):
+        sw = self._switches_by_dpid.pop(dpid, None)
+        if sw is not None:
+            for p in sw.ports:
+                self._port_hw_addr.pop((dpid, p.port_no), None)
+
+    def update_links(self, links):
+        """
+        Replaces the learned links with `links`, indexing only the links that were added or removed.
+        :param links: List of link objects, as returned by get_link()
+        """
+        new = dict((_link_key(l), l) for l in links)
+        changed = False
+        for key, l in list(self._links_by_key.items()):
+            if key not in new:
+                self._unindex_link(l)
+                changed = True
+        for key, l in new.items():
+            old = self._links_by_key.get(key)
+            if old is None:
+                changed = True
+            elif old is l:
+                continue
+            else:
+                self._unindex_link(old)
+            self._index_link(l)
+        self._topo_raw_links = list(links)
+        if changed:
+            self._links_changed()
+
+    def remove_links_at_port(self, dpid, port_no):
+        """
+        Removes the links leaving or entering port port_no of switch dpid.
+        :rtype : list
+        :return: The removed links
+        """
+        removed = [l for l in (self._link_by_src_port.get((dpid, port_no)), self._link_by_dst_port.get((dpid, port_no)))
+                   if l is not None]
+        if removed:
+            for l in removed:
+                self._unindex_link(l)
+            self._topo_raw_links = [l for l in self._topo_raw_links if not any(l is r for r in removed)]
+            self._links_changed()
+        return removed
+
+    def _links_changed(self):
+        self._shortest_path_cache = {}
+        self.links_version += 1
+
+    def _index_link(self, l):
+        self._links_by_key[_link_key(l)] = l
+        self._links_by_src.setdefault(l.src.dpid, []).append(l)
+        self._link_by_src_port[(l.src.dpid, l.src.port_no)] = l
+        self._link_by_dst_port[(l.dst.dpid, l.dst.port_no)] = l
+        self._link_by_pair.setdefault((l.src.dpid, l.dst.dpid), l)
+
+    def _unindex_link(self, l):
+        key = _link_key(l)
+        if self._links_by_key.get(key) is not l:
+            return
+        del self._links_by_key[key]
+        outgoing = self._links_by_src[l.src.dpid]
+        outgoing.remove(l)
+        if not outgoing:
+            del self._links_by_src[l.src.dpid]
+        if self._link_by_src_port.get((l.src.dpid, l.src.port_no)) is l:
+            del self._link_by_src_port[(l.src.dpid, l.src.port_no)]
+        if self._link_by_dst_port.get((l.dst.dpid, l.dst.port_no)) is l:
+            del self._link_by_dst_port[(l.dst.dpid, l.dst.port_no)]
+        pair = (l.src.dpid, l.dst.dpid)
+        if self._link_by_pair.get(pair) is l:
+            del self._link_by_pair[pair]
+            # A parallel link between the same switches takes over
+            for other in outgoing:
+                if other.dst.dpid == l.dst.dpid:
+                    self._link_by_pair[pair] = other
+                    break
+
     def add_flow(self, datapath, priority, match, actions, buffer_id=None):
         """
         Adds a flow to switch with given datapath. The flow has the given priority. For a given match the flow perform the
@@ -417,7 +709,7 @@ class TopoStructure(object):
         else:
             mod = parser.OFPFlowMod(datapath=datapath, priority=priority,
                                     match=match, instructions=inst)
-        datapath.send_msg(mod)
+        self._send(datapath, mod)
 
     def send_flows_for_path(self, in_link_path, dst_addr):
         """
@@ -440,11 +732,11 @@ class TopoStructure(object):
                 self.add_flow(self.get_dp_switch_with_id(temp_dpid), 1, match, actions)
             elif len(ports) > 2:
                 visited_dpids.append(temp_dpid)
-                print("Need to be implemented.")
+                LOG.warning("Need to be implemented.")
 
         end_points = [x for x in u_dpids if x not in visited_dpids]
         if len(end_points) > 2:
-            print("There is something wrong. There is two endpoints for a link")
+            LOG.error("There is something wrong. There is two endpoints for a link")
 
         for temp_dpid_endpoint in end_points:
             other_port = self.find_ports_for_dpid(temp_dpid_endpoint, in_link_path)
@@ -496,10 +788,9 @@ class TopoStructure(object):
 
                 # The variable ports is a list of ports for switch with dpid equal to temp_dpid which the ports
                 # are used in the list of links `in_link_path`
-                print("(l.src.dpid: {0})".format(l.src.dpid))
                 src_dpid_ports = self.find_ports_for_dpid(l.src.dpid, in_link_path)
                 if len(src_dpid_ports) > 1:
-                    print "There should be one port"
+                    LOG.warning("There should be one port")
 
                 sw_port_connected_to_src_host = self.ip_cache.get_port_num_connected_to_sw(in_dpid=l.src.dpid, in_ip=src_ip)
 
@@ -509,8 +800,8 @@ class TopoStructure(object):
                 # See http://ryu.readthedocs.org/en/latest/ofproto_v1_3_ref.html
                 match = ofp_parser.OFPMatch(in_port=sw_port_connected_to_src_host, eth_dst=host_eth_dst_addr)
                 actions = [ofp_parser.OFPActionOutput(port=l.src.port_no)]
-                print("\tFF: Adding flow to {0} dpid. Match.in_port: {1} Match.eth_dst: {2} Match.arp_tpa: {3} Actions.port: {4}".format(
-                    l.src.dpid, sw_port_connected_to_src_host, host_eth_dst_addr, "NONE", l.src.port_no))
+                LOG.debug("FF: Adding flow to %s dpid. Match.in_port: %s Match.eth_dst: %s Actions.port: %s",
+                          l.src.dpid, sw_port_connected_to_src_host, host_eth_dst_addr, l.src.port_no)
                 # Gets datapath object of the switch with dpid equal to temp_dpid
                 self.add_flow(src_dp, 1, match, actions)
 
@@ -519,7 +810,7 @@ class TopoStructure(object):
                 # are used in the list of links `in_link_path`
                 dst_dpid_ports = self.find_ports_for_dpid(l.dst.dpid, in_link_path)
                 if len(dst_dpid_ports) > 1:
-                    print "There should be one port"
+                    LOG.warning("There should be one port")
 
                 # dst_dp if the datapath object for the switch with datapath id of l.dst.dpid
                 dst_dp = self.get_dp_switch_with_id(l.dst.dpid)
@@ -530,14 +821,14 @@ class TopoStructure(object):
                 sw_port_connected_to_dst_host = self.ip_cache.get_port_num_connected_to_sw(in_dpid=l.dst.dpid, in_ip=dst_ip)
                 if sw_port_connected_to_dst_host > 0:
                     actions = [ofp_parser.OFPActionOutput(port=sw_port_connected_to_dst_host)]
-                    print("\tSF: Adding flow to {0} dpid. Match.in_port: {1} Match.eth_dst: {2} Match.arp_tpa: {3} Actions.port: {4}".format(
-                        dst_dp.id, l.dst.port_no, host_eth_dst_addr, "NONE", sw_port_connected_to_dst_host))
+                    LOG.debug("SF: Adding flow to %s dpid. Match.in_port: %s Match.eth_dst: %s Actions.port: %s",
+                              dst_dp.id, l.dst.port_no, host_eth_dst_addr, sw_port_connected_to_dst_host)
 
                     # Gets datapath object of the switch with dpid equal to temp_dpid
                     self.add_flow(dst_dp, 1, match, actions)
 
                 else:
-                    print("Port Number if neg")
+                    LOG.warning("Port Number if neg")
 
             if ind < (len(in_link_path)-1) and (ind + 1) < len(in_link_path):
                 # Adding flows for the switches in the middle
@@ -549,8 +840,240 @@ class TopoStructure(object):
                 match = ofp_parser.OFPMatch(in_port=l.dst.port_no, eth_dst=host_eth_dst_addr)
                 actions = [ofp_parser.OFPActionOutput(port=in_link_path[ind+1].src.port_no)]
                 self.add_flow(mid_dp, 1, match, actions)
-                print("\tSF: Adding flow to {0} dpid. Match.in_port: {1} Match.eth_dst: {2} Match.arp_tpa: {3} Actions.port: {4}".format(
-                        mid_dp.id, l.dst.port_no, host_eth_dst_addr, "NONE", in_link_path[ind+1].src.port_no))
+                LOG.debug("SF: Adding flow to %s dpid. Match.in_port: %s Match.eth_dst: %s Actions.port: %s",
+                          mid_dp.id, l.dst.port_no, host_eth_dst_addr, in_link_path[ind+1].src.port_no)
+
+    def find_link_disjoint_path(self, in_link_path):
+        """
+        Finds the shortest path between the endpoints of in_link_path that uses none of its links, in either direction.
+        :param in_link_path: A list of link objects (a path)
+        :rtype : list
+        :return: A list of link objects, empty if there is no such path.
+        """
+        used = set()
+        for l in in_link_path:
+            used.add((l.src.dpid, l.dst.dpid))
+            used.add((l.dst.dpid, l.src.dpid))
+        src_dpid = self.get_first_sw_dpid_in_linklist(in_link_path)
+        dst_dpid = self.get_last_sw_dpid_in_linklist(in_link_path)
+        _, shortest_path_node = self.find_shortest_path(
+            src_dpid, weight=lambda l: None if (l.src.dpid, l.dst.dpid) in used else 1)
+        if dst_dpid not in shortest_path_node:
+            return []
+        return self.convert_dpid_path_to_links(self.find_path(s=src_dpid, d=dst_dpid, s_p_n=shortest_path_node))
+
+    def install_path(self, src_ip, dst_ip, in_link_path, protect=True):
+        """
+        Installs the flows from host src_ip to host dst_ip along in_link_path and records the path in installed_paths.
+        The flows match on the hw addresses of both hosts, so every pair has its own flows and groups and paths of
+        different pairs crossing a switch never overwrite each other.
+        With protect the path is protected by a link-disjoint backup path the switches fail over to by themselves:
+        every switch of the path forwards through an OFPGT_FF group. On the first switch the group watches the path port
+        and then the first port of the backup path. On the others it watches the next port of the path and then sends
+        the packet back where it came from (crank back). Packets coming back are passed upstream until the first switch,
+        which puts them on the backup path.
+        Without protect, or if there is no backup path, the flows just forward along in_link_path.
+        Nothing is sent if the same path is already installed the same way, to the same host ports and hw addresses, and
+        the links did not change since.
+
+        :type src_ip: str
+        :param src_ip: Ip address of the source host
+        :type dst_ip: str
+        :param dst_ip: Ip address of the destination host
+        :type in_link_path: list
+        :param in_link_path: A list of link objects between switches.
+        :type protect: bool
+        :param protect: Whether to install fast failover groups and a backup path
+        :rtype : InstalledPath or None
+        :return: The installed path, None if nothing could be sent.
+        """
+        # A host may have moved, or another host may have taken its ip, since the path was installed
+        src_port = self.ip_cache.get_port_num_connected_to_sw(in_dpid=in_link_path[0].src.dpid, in_ip=src_ip)
+        dst_port = self.ip_cache.get_port_num_connected_to_sw(in_dpid=in_link_path[-1].dst.dpid, in_ip=dst_ip)
+        src_mac = self.ip_cache.get_hw_address_of_host(in_ip=src_ip)
+        dst_mac = self.ip_cache.get_hw_address_of_host(in_ip=dst_ip)
+        installed = self.installed_paths.get((src_ip, dst_ip))
+        if installed is not None and installed.links_version == self.links_version and installed.protect == protect \
+                and (installed.src_port, installed.dst_port, installed.src_mac, installed.dst_mac) == \
+                (src_port, dst_port, src_mac, dst_mac) \
+                and [_link_key(l) for l in installed.primary] == [_link_key(l) for l in in_link_path]:
+            return installed
+
+        backup = self.find_link_disjoint_path(in_link_path) if protect else []
+        path = InstalledPath(src_ip, dst_ip, src_port, dst_port, src_mac, dst_mac, list(in_link_path), backup, protect,
+                             self.links_version)
+        if not self._send_path_flows(path):
+            return None
+        if installed is not None:
+            # The flows of the new path have replaced or stopped using the old groups
+            self.forget_path(src_ip, dst_ip, replaced_by=path)
+        self.installed_paths[(src_ip, dst_ip)] = path
+        for l in path.primary + path.backup:
+            self.paths_by_link.setdefault(_link_key(l), set()).add((src_ip, dst_ip))
+        return path
+
+    def forget_path(self, src_ip, dst_ip, replaced_by=None):
+        """
+        Removes the path from src_ip to dst_ip from installed_paths and deletes its flows and the fast failover groups
+        only it used, except the flows replaced_by has just sent with the same match.
+        """
+        path = self.installed_paths.pop((src_ip, dst_ip), None)
+        if path is None:
+            return
+        for l in path.primary + path.backup:
+            key = _link_key(l)
+            paths = self.paths_by_link.get(key)
+            if paths is not None:
+                paths.discard((src_ip, dst_ip))
+                if not paths:
+                    del self.paths_by_link[key]
+        keep = set(replaced_by.flows) if replaced_by is not None else set()
+        for key in path.flows:
+            if key not in keep:
+                dp = self.get_dp_switch_with_id(key[0])
+                if dp is not None:
+                    self._send(dp, dp.ofproto_parser.OFPFlowMod(
+                        datapath=dp, command=dp.ofproto.OFPFC_DELETE_STRICT, priority=1,
+                        out_port=dp.ofproto.OFPP_ANY, out_group=dp.ofproto.OFPG_ANY,
+                        match=self._path_match(path, dp, key[1])))
+        self._release_groups(path)
+
+    def paths_using_links(self, links):
+        """
+        Returns the (src ip, dst ip) of the installed paths using any of the links, on their primary or backup path.
+        :param links: List of link objects
+        :rtype : list
+        """
+        paths = set()
+        for l in links:
+            paths.update(self.paths_by_link.get(_link_key(l), ()))
+        return sorted(paths)
+
+    def begin_batch(self):
+        """
+        Holds back the messages sent to the switches until flush_batch().
+        """
+        self._batch = {}
+
+    def flush_batch(self):
+        """
+        Sends the messages held back since begin_batch() switch by switch, each batch followed by a barrier request.
+        :rtype : list
+        :return: The (dpid, xid) of the barrier requests
+        """
+        batch, self._batch = self._batch, None
+        barriers = []
+        for dpid, (datapath, msgs) in (batch or {}).items():
+            for msg in msgs:
+                datapath.send_msg(msg)
+            barrier = datapath.ofproto_parser.OFPBarrierRequest(datapath)
+            datapath.set_xid(barrier)
+            datapath.send_msg(barrier)
+            barriers.append((dpid, barrier.xid))
+        return barriers
+
+    def _send(self, datapath, msg):
+        if self._batch is None:
+            datapath.send_msg(msg)
+        else:
+            self._batch.setdefault(datapath.id, (datapath, []))[1].append(msg)
+
+    def _send_path_flows(self, path):
+        """
+        Sends the flows of path, protected when it has a backup.
+        :rtype : bool
+        :return: False, with nothing sent, if the switch port of one of the hosts is not known.
+        """
+        if path.src_port <= 0 or path.dst_port <= 0:
+            LOG.warning("Port Number if neg: %s port %s, %s port %s, path not installed",
+                        path.src_ip, path.src_port, path.dst_ip, path.dst_port)
+            return False
+        if path.backup:
+            self._send_protected_flows(path)
+        else:
+            # Downstream first so that no switch forwards to one which is not ready yet
+            primary = path.primary
+            self._send_output_flow(path, primary[-1].dst.dpid, primary[-1].dst.port_no, path.dst_port)
+            for prev, l in reversed(list(zip(primary, primary[1:]))):
+                self._send_output_flow(path, l.src.dpid, prev.dst.port_no, l.src.port_no)
+            self._send_output_flow(path, primary[0].src.dpid, path.src_port, primary[0].src.port_no)
+        return True
+
+    def _send_protected_flows(self, path):
+        primary = path.primary
+        backup = path.backup
+
+        # Downstream first so that no switch forwards to one which is not ready yet, and groups before their flows.
+        self._send_output_flow(path, primary[-1].dst.dpid, primary[-1].dst.port_no, path.dst_port)
+        self._send_output_flow(path, backup[-1].dst.dpid, backup[-1].dst.port_no, path.dst_port)
+        for prev, l in zip(backup, backup[1:]):
+            self._send_output_flow(path, l.src.dpid, prev.dst.port_no, l.src.port_no)
+        # Crank back: packets coming back from downstream go upstream, the first switch puts them on the backup path
+        self._send_output_flow(path, primary[0].src.dpid, primary[0].src.port_no, backup[0].src.port_no)
+        for prev, l in zip(primary, primary[1:]):
+            self._send_output_flow(path, l.src.dpid, l.src.port_no, prev.dst.port_no)
+        for prev, l in reversed(list(zip(primary, primary[1:]))):
+            self._send_failover_flow(path, l.src.dpid, prev.dst.port_no, l.src.port_no, None)
+        self._send_failover_flow(path, primary[0].src.dpid, path.src_port, primary[0].src.port_no,
+                                 backup[0].src.port_no)
+
+    def _path_match(self, path, dp, in_port):
+        return dp.ofproto_parser.OFPMatch(in_port=in_port, eth_src=path.src_mac, eth_dst=path.dst_mac)
+
+    def _send_output_flow(self, path, dpid, in_port, out_port):
+        dp = self.get_dp_switch_with_id(dpid)
+        path.flows.append((dpid, in_port, path.src_mac, path.dst_mac))
+        self.add_flow(dp, 1, self._path_match(path, dp, in_port), [dp.ofproto_parser.OFPActionOutput(port=out_port)])
+
+    def _send_failover_flow(self, path, dpid, in_port, out_port, backup_port):
+        """
+        Sends an OFPGT_FF group forwarding to out_port while it is up and then to backup_port, or back to in_port when
+        backup_port is None, and a flow sending the packets of path coming from in_port to the group. The group of the
+        path this one replaces is modified instead of adding a new one when it has the same flow match.
+        """
+        dp = self.get_dp_switch_with_id(dpid)
+        ofp = dp.ofproto
+        ofp_parser = dp.ofproto_parser
+        key = (dpid, in_port, path.src_mac, path.dst_mac)
+        group = self._failover_groups.get(key)
+        if group is None:
+            group_id = self._last_group_id.get(dpid, 0) + 1
+            self._last_group_id[dpid] = group_id
+            group = self._failover_groups[key] = [group_id, set()]
+            command = ofp.OFPGC_ADD
+        else:
+            group_id = group[0]
+            command = ofp.OFPGC_MODIFY
+        if backup_port is None:
+            backup_bucket = ofp_parser.OFPBucket(watch_port=in_port, watch_group=ofp.OFPG_ANY,
+                                                 actions=[ofp_parser.OFPActionOutput(ofp.OFPP_IN_PORT)])
+        else:
+            backup_bucket = ofp_parser.OFPBucket(watch_port=backup_port, watch_group=ofp.OFPG_ANY,
+                                                 actions=[ofp_parser.OFPActionOutput(backup_port)])
+        buckets = [ofp_parser.OFPBucket(watch_port=out_port, watch_group=ofp.OFPG_ANY,
+                                        actions=[ofp_parser.OFPActionOutput(out_port)]),
+                   backup_bucket]
+        self._send(dp, ofp_parser.OFPGroupMod(dp, command, ofp.OFPGT_FF, group_id, buckets))
+        group[1].add(path)
+        path.groups.append(key)
+        path.flows.append(key)
+        self.add_flow(dp, 1, self._path_match(path, dp, in_port), [ofp_parser.OFPActionGroup(group_id)])
+
+    def _release_groups(self, path):
+        """
+        Deletes the fast failover groups, and with them their flows, which are not used by another path any more.
+        """
+        for key in path.groups:
+            group = self._failover_groups.get(key)
+            if group is None:
+                continue
+            group[1].discard(path)
+            if group[1]:
+                continue
+            del self._failover_groups[key]
+            dp = self.get_dp_switch_with_id(key[0])
+            if dp is not None:
+                self._send(dp, dp.ofproto_parser.OFPGroupMod(dp, dp.ofproto.OFPGC_DELETE, dp.ofproto.OFPGT_FF, group[0]))
 
     def send_midpoint_flows_for_path(self, in_path):
         """
@@ -571,7 +1094,7 @@ class TopoStructure(object):
                 actions = [ofproto_v1_3_parser.OFPActionOutput(port=ports[0])]
                 self.add_flow(self.get_dp_switch_with_id(temp_dpid), 1, match, actions)
             elif len(ports) > 2:
-                print("Need to be implemented.")
+                LOG.warning("Need to be implemented.")
 
     def find_backup_path(self, link, shortest_path_node):
         """
@@ -587,7 +1110,7 @@ class TopoStructure(object):
         d = link.dst.dpid
         if d == s:
             # If destination address and source address is same there is something wrong.
-            print("Link Error")
+            LOG.error("Link Error")
         # The bk_path is a list of DPIDs that the path must go through to reach d from s
         bk_path = []
         bk_path.append(d)
@@ -611,7 +1134,7 @@ class TopoStructure(object):
         :return: a list of dpids that the msg has to go though in order to reach destination
         """
         if d == s:
-            print("Link Error")
+            LOG.error("Link Error")
         # The found_path is a list of DPIDs that the path must go through to reach d from s
         found_path = []
         found_path.append(d)
@@ -632,9 +1155,9 @@ class TopoStructure(object):
         """
         reverted_list = []
         for l in reversed(link_list):
-            for ll in self.topo_raw_links:
-                if l.dst.dpid == ll.src.dpid and l.src.dpid == ll.dst.dpid:
-                    reverted_list.append(ll)
+            ll = self._link_by_pair.get((l.dst.dpid, l.src.dpid))
+            if ll is not None:
+                reverted_list.append(ll)
         return (reverted_list)
 
     def convert_dpid_path_to_links(self, dpid_list):
@@ -647,11 +1170,9 @@ class TopoStructure(object):
         backup_links = []
         for i, v in enumerate(dpid_list):
             if not i > (len(dpid_list)-1) and not i+1 > (len(dpid_list)-1):
-                s = v
-                d = dpid_list[i+1]
-                for link in self.topo_raw_links:
-                    if link.dst.dpid == d and link.src.dpid == s:
-                        backup_links.append(link)
+                link = self._link_by_pair.get((v, dpid_list[i+1]))
+                if link is not None:
+                    backup_links.append(link)
         return backup_links
 
     def get_last_sw_dpid_in_linklist(self, in_linklist):
@@ -664,33 +1185,31 @@ class TopoStructure(object):
 
     def print_links(self, func_str=None):
         """
-        Uses the built in __str__ function to print the links saved in the class `topo_raw_links`.
-        :param func_str: A string which will be printed to help user locate the its prints
+        Uses the built in __str__ function to log the links saved in the class `topo_raw_links` at debug level.
+        :param func_str: A string which will be logged to help user locate the its logs
         """
-        print(" \t" + str(func_str) + ": Current Links:")
-        for l in self.topo_raw_links:
-            print (" \t\t" + str(l))
+        if not LOG.isEnabledFor(logging.DEBUG):
+            return
+        LOG.debug("%s: Current Links:\n%s", func_str, "\n".join("\t" + str(l) for l in self.topo_raw_links))
 
     def print_input_links(self, list_links):
         """
-        Uses the built in __str__ function to print the links.
+        Uses the built in __str__ function to log the links at debug level.
         :param list_links: LIst of link objects.
         """
-        print(" \t Given Links:")
-        for l in list_links:
-            print (" \t\t" + str(l))
+        if not LOG.isEnabledFor(logging.DEBUG):
+            return
+        LOG.debug("Given Links:\n%s", "\n".join("\t" + str(l) for l in list_links))
 
     def print_switches(self, func_str=None):
         """
-        Uses the built in __str__ function to print the links saved in the class `topo_raw_switches`.
-        :param func_str: A string which will be printed to help user locate the its prints
+        Uses the built in __str__ function to log the switches saved in the class `topo_raw_switches` at debug level.
+        :param func_str: A string which will be logged to help user locate the its logs
         """
-        print(" \t" + str(func_str) + ": Current Switches:")
-        for s in self.topo_raw_switches:
-            print (" \t\t" + str(s))
-            print("\t\t\t Printing HW address:")
-            for p in s.ports:
-                print ("\t\t\t " + str(p.hw_addr))
+        if not LOG.isEnabledFor(logging.DEBUG):
+            return
+        LOG.debug("%s: Current Switches:\n%s", func_str, "\n".join(
+            "\t%s HW addresses: %s" % (s, " ".join(str(p.hw_addr) for p in s.ports)) for s in self.topo_raw_switches))
 
     def get_hw_addresses_for_dpid(self, in_dpid):
         """
@@ -698,12 +1217,10 @@ class TopoStructure(object):
         :param in_dpid: Datapath id of the switch.
         :rtype : list
         """
-        list_of_HW_addr = []
-        for s in self.topo_raw_switches:
-            if s.dp.id == in_dpid:
-                for p in s.ports:
-                    list_of_HW_addr.append(p.hw_addr)
-        return list_of_HW_addr
+        s = self._switches_by_dpid.get(in_dpid)
+        if s is None:
+            return []
+        return [p.hw_addr for p in s.ports]
 
     def get_hw_address_for_port_of_dpid(self, in_dpid, in_port_no):
         """
@@ -712,14 +1229,7 @@ class TopoStructure(object):
         :param in_port_no: A port number on the switch
         :rtype : int or str
         """
-        for s in self.topo_raw_switches:
-            # here s is a switch object
-            if s.dp.id == in_dpid:
-                for p in s.ports:
-                    # p is the port object
-                    if p.port_no == in_port_no:
-                        return p.hw_addr
-        return -1
+        return self._port_hw_addr.get((in_dpid, in_port_no), -1)
 
     def get_switches_dpid(self):
         """
@@ -748,24 +1258,25 @@ class TopoStructure(object):
         :param dpid: Datapath id of the switch
         :rtype : object
         """
-        for s in self.topo_raw_switches:
-            if s.dp.id == dpid:
-                return s.dp
-        return None
+        s = self._switches_by_dpid.get(dpid)
+        return s.dp if s is not None else None
 
     def switches_count(self):
         """
         Returns the number of current learned switches
         :rtype : int
         """
-        return len(self.topo_raw_switches)
+        return len(self._switches_by_dpid)
 
     def bring_up_link(self, link):
         """
         Adds the link to list of raw links
         :rtype : Link
         """
-        self.topo_raw_links.append(link)
+        if _link_key(link) not in self._links_by_key:
+            self._topo_raw_links.append(link)
+            self._index_link(link)
+            self._links_changed()
 
     def check_link(self, sdpid, sport, ddpid, dport):
         """
@@ -777,11 +1288,7 @@ class TopoStructure(object):
         :param dport: Destination port number
         :rtype : bool
         """
-        for i, link in self.topo_raw_links:
-            if ((sdpid, sport), (ddpid, dport)) == (
-                    (link.src.dpid, link.src.port_no), (link.dst.dpid, link.dst.port_no)):
-                return True
-        return False
+        return (sdpid, sport, ddpid, dport) in self._links_by_key
 
     def find_ports_for_dpid(self, dpid, link_list):
         """
@@ -817,70 +1324,52 @@ class TopoStructure(object):
                 dp_ids.append(dp_ids.append(dp_ids))
         return dp_ids
 
-    def find_shortest_path(self, s):
+    def find_shortest_path(self, s, weight=None):
         """
-        Finds the shortest path from source s to all other nodes.
+        Finds the shortest path from source s to all other nodes with Dijkstra.
+        Every link costs 1 unless weight is given, either as a dict {(src dpid, dst dpid): cost} (missing links
+        cost 1) or as a function of the link object. A cost of None leaves the link out.
+        Unweighted results are cached per source until the links change.
         :param s: Source Dpid
-        :rtype : shortest_path_hubs -> Number of hubs it takes for each destination to reach from source with dpid s.
+        :param weight: Optional link costs, must not be negative
+        :rtype : shortest_path_hubs -> Number of hubs (or the total cost when weighted) it takes for each
+                                       destination to reach from source with dpid s.
                  shortest_path_node -> The dpid of last node which a packet must pass in order to reach the destination.
         """
-        # I really recommend watching this video: https://www.youtube.com/watch?v=zXfDYaahsNA
-        s_count = self.switches_count()
-        s_temp = s
-
-        # If you wanna see the prinfs set this to one.
-        verbose = 0
-
-        visited = []
-
-        Fereng = []
-        Fereng.append(s_temp)
-
+        if weight is None:
+            cached = self._shortest_path_cache.get(s)
+            if cached is None:
+                cached = self._shortest_path_cache[s] = self._dijkstra(s, None)
+        else:
+            cached = self._dijkstra(s, weight)
+        # Callers such as find_path_from_topo() consume the dicts, hand out copies
+        return dict(cached[0]), dict(cached[1])
+
+    def _dijkstra(self, s, weight):
+        if isinstance(weight, dict):
+            costs = weight
+            weight = lambda l: costs.get((l.src.dpid, l.dst.dpid), 1)
+        adjacency = self._links_by_src
         # Records number of hubs which you can reach the node from specified src
-        shortest_path_hubs = {}
+        shortest_path_hubs = {s: 0}
         # The last node which you can access the node from. For example: {1,2} means you can reach node 1 from node 2.
-        shortest_path_node = {}
-        shortest_path_hubs[s_temp] = 0
-        shortest_path_node[s_temp] = s_temp
-        while s_count > len(visited):
-            if verbose == 1: print "visited in: " + str(visited)
-            visited.append(s_temp)
-            if verbose == 1: print ("Fereng in: " + str(Fereng))
-            if verbose == 1: print ("s_temp in: " + str(s_temp))
-            for l in self.find_links_with_src(s_temp):
-                if verbose == 1: print "\t" + str(l)
-                if l.dst.dpid not in visited:
-                    Fereng.append(l.dst.dpid)
-                if verbose == 1: print ("\tAdded {0} to Fereng: ".format(l.dst.dpid))
-                if l.dst.dpid in shortest_path_hubs:
-                    # Find the minimum o
-                    if shortest_path_hubs[l.src.dpid] + 1 < shortest_path_hubs[l.dst.dpid]:
-                        shortest_path_hubs[l.dst.dpid] = shortest_path_hubs[l.src.dpid] + 1
-                        shortest_path_node[l.dst.dpid] = l.src.dpid
-                    else:
-                        shortest_path_hubs[l.dst.dpid] = shortest_path_hubs[l.dst.dpid]
-
-                    if verbose == 1: print(
-                        "\t\tdst dpid found in shortest_path. Count: " + str(shortest_path_hubs[l.dst.dpid]))
-                elif l.src.dpid in shortest_path_hubs and l.dst.dpid not in shortest_path_hubs:
-                    if verbose == 1: print("\t\tdst dpid not found bit src dpid found.")
-                    shortest_path_hubs[l.dst.dpid] = shortest_path_hubs[l.src.dpid] + 1
-                    shortest_path_node[l.dst.dpid] = l.src.dpid
-            if verbose == 1:
-                print ("shortest_path Hubs: " + str(shortest_path_hubs))
-                print ("shortest_path Node: " + str(shortest_path_node))
-            if s_temp in Fereng:
-                Fereng.remove(s_temp)
-            #min_val = min(Fereng)
-            if verbose == 1: print ("Fereng out: " + str(Fereng))
-            t_dpid = [k for k in Fereng if k not in visited]
-            if verbose == 1: print ("Next possible dpids (t_dpid): " + str(t_dpid))
-
-            if len(t_dpid) != 0:
-                s_temp = t_dpid[t_dpid.index(min(t_dpid))]
-
-            if verbose == 1: print "s_temp out: " + str(s_temp)
-            if verbose == 1: print "visited out: " + str(visited) + "\n"
+        shortest_path_node = {s: s}
+        visited = set()
+        heap = [(0, s)]
+        while heap:
+            distance, dpid = heapq.heappop(heap)
+            if dpid in visited:
+                continue
+            visited.add(dpid)
+            for l in adjacency.get(dpid, ()):
+                cost = 1 if weight is None else weight(l)
+                if cost is None:
+                    continue
+                candidate = distance + cost
+                if l.dst.dpid not in shortest_path_hubs or candidate < shortest_path_hubs[l.dst.dpid]:
+                    shortest_path_hubs[l.dst.dpid] = candidate
+                    shortest_path_node[l.dst.dpid] = dpid
+                    heapq.heappush(heap, (candidate, l.dst.dpid))
         return shortest_path_hubs, shortest_path_node
 
     def find_path_from_topo(self,src_dpid, dst_dpid, shortest_path_node):
@@ -899,12 +1388,12 @@ class TopoStructure(object):
             if last_node != None:
                 l = self.link_from_src_to_dst(now_node, last_node)
                 if l is None:
-                    print("Link between {0} and {1} was not found in topo.".format(now_node, last_node))
+                    LOG.error("Link between %s and %s was not found in topo.", now_node, last_node)
                 else:
                     path.append(l)
                     now_node = last_node
             else:
-                print "Path could not be found"
+                LOG.error("Path could not be found")
         return path
 
     def find_dst_with_src(self, s_dpid):
@@ -913,11 +1402,7 @@ class TopoStructure(object):
         :param s_dpid: Source datapath id
         :rtype : list
         """
-        d = []
-        for l in self.topo_raw_links:
-            if l.src.dpid == s_dpid:
-                d.append(l.dst.dpid)
-        return d
+        return [l.dst.dpid for l in self._links_by_src.get(s_dpid, ())]
 
     def find_links_with_src(self, s_dpid):
         """
@@ -925,11 +1410,7 @@ class TopoStructure(object):
         :param s_dpid: Source datapath id
         :rtype : list
         """
-        d_links = []
-        for l in self.topo_raw_links:
-            if l.src.dpid == s_dpid:
-                d_links.append(l)
-        return d_links
+        return list(self._links_by_src.get(s_dpid, ()))
 
     def link_with_src_dst_port(self, in_port, in_dpid):
         """
@@ -938,11 +1419,8 @@ class TopoStructure(object):
         :param in_dpid: Datapath id of the switch
         :rtype : Link or None
         """
-        for l in self.topo_raw_links:
-            if (l.src.dpid == in_dpid and l.src.port_no == in_port) or (
-                            l.dst.dpid == in_dpid and l.src.port_no == in_port):
-                return l
-        return None
+        l = self._link_by_src_port.get((in_dpid, in_port))
+        return l if l is not None else self._link_by_dst_port.get((in_dpid, in_port))
 
     def link_from_src_to_dst(self, s_dpid, d_dpid):
         """
@@ -951,10 +1429,7 @@ class TopoStructure(object):
         :param d_dpid: Destination dpid
         :rtype : Link or None
         """
-        for l in self.topo_raw_links:
-            if l.src.dpid == s_dpid and l.dst.dpid == d_dpid:
-                return l
-        return None
+        return self._link_by_pair.get((s_dpid, d_dpid))
 
     def link_with_src_and_port(self, in_port, in_dpid):
         """
@@ -963,10 +1438,7 @@ class TopoStructure(object):
         :param in_dpid: Datapath id of the source switch
         :rtype : Link
         """
-        for l in self.topo_raw_links:
-            if (l.src.dpid == in_dpid and l.src.port_no == in_port):
-                return l
-        return None
+        return self._link_by_src_port.get((in_dpid, in_port))
 
     def link_with_dst_and_port(self, in_port, in_dpid):
         """
@@ -975,7 +1447,4 @@ class TopoStructure(object):
         :param in_dpid: Datapath id of the destination switch
         :rtype : Link
         """
-        for l in self.topo_raw_links:
-            if (l.dst.dpid == in_dpid and l.dst.port_no == in_port):
-                return l
-        return None
+        return self._link_by_dst_port.get((in_dpid, in_port))
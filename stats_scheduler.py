@@ -0,0 +1,159 @@
+"""
+Staggered, adaptive scheduler for OpenFlow stats polling.
+
+The scheduler does not depend on Ryu: the app drives it from its monitor thread, e.g.
+
+    while True:
+        hub.sleep(self.poll_scheduler.tick())
+
+and notifies it from the reply handlers with reply(dpid, kind).
+"""
+import time
+from collections import deque
+
+# Fractional part of the golden ratio, spreads start offsets evenly for any number of switches
+_GOLDEN = 0.6180339887498949
+
+
+class PollState(object):
+    __slots__ = ('dpid', 'period', 'next_due', 'outstanding', 'sent_at', 'last_sample', 'intervals',
+                 'polls', 'timeouts')
+
+    def __init__(self, dpid, period, next_due, history):
+        self.dpid = dpid
+        self.period = period
+        self.next_due = next_due
+        # Kinds of reply ('port', 'flow', ...) still expected for the last request
+        self.outstanding = set()
+        self.sent_at = None
+        self.last_sample = None
+        # Achieved intervals between two completed samples
+        self.intervals = deque(maxlen=history)
+        self.polls = 0
+        self.timeouts = 0
+
+
+class StatsPollScheduler(object):
+    """
+    Spreads the stats requests of all datapaths over the polling period instead of sending them in
+    one burst, adapts the period of every datapath to its activity and never re-polls a datapath
+    that has not answered the previous request (unless it timed out).
+
+    :param send: callable(dpid) sending the requests and returning the kinds of reply to wait for
+    :param base_period: initial polling period in seconds
+    :param min_period: lower bound for busy datapaths
+    :param max_period: upper bound for idle datapaths
+    :param speedup: factor applied to the period when a datapath reports activity
+    :param slowdown: factor applied to the period when a datapath is idle
+    :param timeout_factor: a request is considered lost after timeout_factor * period seconds
+    """
+    def __init__(self, send, base_period=10.0, min_period=2.0, max_period=60.0, speedup=0.5, slowdown=1.5,
+                 timeout_factor=3.0, history=32, clock=time.time):
+        self.send = send
+        self.base_period = base_period
+        self.min_period = min_period
+        self.max_period = max_period
+        self.speedup = speedup
+        self.slowdown = slowdown
+        self.timeout_factor = timeout_factor
+        self.history = history
+        self.clock = clock
+        self.polls = {}
+        self._added = 0
+
+    def add(self, dpid):
+        if dpid in self.polls:
+            return
+        offset = (self._added * _GOLDEN) % 1.0 * self.base_period
+        self._added += 1
+        self.polls[dpid] = PollState(dpid, self.base_period, self.clock() + offset, self.history)
+
+    def remove(self, dpid):
+        self.polls.pop(dpid, None)
+
+    def tick(self):
+        """
+        Sends the requests that are due and returns the number of seconds until the next one.
+        """
+        now = self.clock()
+        wake = now + self.base_period
+        for state in list(self.polls.values()):
+            if state.outstanding:
+                deadline = state.sent_at + self.timeout_factor * state.period
+                if now < deadline:
+                    wake = min(wake, deadline)
+                    continue
+                # The switch never answered, give up on that request
+                state.timeouts += 1
+                state.outstanding = set()
+            if now >= state.next_due:
+                state.outstanding = set(self.send(state.dpid) or ())
+                state.sent_at = now
+                state.polls += 1
+                state.next_due = now + state.period
+                if state.outstanding:
+                    wake = min(wake, now + self.timeout_factor * state.period)
+            wake = min(wake, state.next_due)
+        return max(wake - now, 0.0)
+
+    def round_trip(self, dpid):
+        """
+        Seconds since the outstanding request of dpid was sent, None if nothing is outstanding.
+        """
+        state = self.polls.get(dpid)
+        if state is None or not state.outstanding:
+            return None
+        return self.clock() - state.sent_at
+
+    def reply(self, dpid, kind):
+        """
+        Records a reply of the given kind. Returns True when it completes the outstanding request.
+        """
+        state = self.polls.get(dpid)
+        if state is None or kind not in state.outstanding:
+            return False
+        state.outstanding.discard(kind)
+        if state.outstanding:
+            return False
+        now = self.clock()
+        if state.last_sample is not None:
+            state.intervals.append(now - state.last_sample)
+        state.last_sample = now
+        return True
+
+    def report_activity(self, dpid, active):
+        """
+        Polls an active (hot or changing) datapath faster and an idle one slower.
+        """
+        state = self.polls.get(dpid)
+        if state is None:
+            return
+        if active:
+            period = max(self.min_period, state.period * self.speedup)
+        else:
+            period = min(self.max_period, state.period * self.slowdown)
+        if period < state.period:
+            # Bring the next poll forward instead of waiting for the old period to expire
+            state.next_due = min(state.next_due, (state.sent_at or self.clock()) + period)
+        state.period = period
+
+    def achieved_intervals(self, dpid):
+        state = self.polls.get(dpid)
+        return list(state.intervals) if state is not None else []
+
+    def report(self):
+        """
+        Returns {dpid: {'period', 'achieved_mean', 'achieved_last', 'polls', 'timeouts', 'outstanding'}}.
+        """
+        report = {}
+        for dpid, state in self.polls.items():
+            intervals = state.intervals
+            report[dpid] = {
+                'period': state.period,
+                'achieved_mean': sum(intervals) / len(intervals) if intervals else None,
+                'achieved_last': intervals[-1] if intervals else None,
+                'polls': state.polls,
+                'timeouts': state.timeouts,
+                'outstanding': sorted(state.outstanding),
+            }
+        return report
@@ -4,12 +4,15 @@ from ryu.controller import ofp_event
 from ryu.controller.handler import MAIN_DISPATCHER, DEAD_DISPATCHER
 from ryu.controller.handler import set_ev_cls
 from ryu.lib import hub
+from stats_scheduler import StatsPollScheduler
 
 class SimpleMonitor13(simple_switch_13.SimpleSwitch13):
     def __init__(self, *args, **kwargs):
         super(SimpleMonitor13, self).__init__(*args, **kwargs)
         self.datapaths = {}
         self.monitor_thread = hub.spawn(self._monitor)
+        # Spreads the requests over the 30s period and skips switches that did not answer yet
+        self.poll_scheduler = StatsPollScheduler(self._poll_datapath, base_period=30)
 
     # Fills controller table with currently connected switches (dynamic)
     @set_ev_cls(ofp_event.EventOFPStateChange, [MAIN_DISPATCHER, DEAD_DISPATCHER])
@@ -21,20 +24,25 @@ class SimpleMonitor13(simple_switch_13.SimpleSwitch13):
                 # Check if the datapath is not already registered
                 self.logger.debug('register datapath: %016x', datapath.id)
                 self.datapaths[datapath.id] = datapath  # Register the datapath in a dictionary
+                self.poll_scheduler.add(datapath.id)
         elif ev.state == DEAD_DISPATCHER:
             # Handler for when the datapath (switch) transitions to DEAD_DISPATCHER state -> disconnected
             if datapath.id in self.datapaths:
                 # Check if the datapath is currently registered
                 self.logger.debug('unregister datapath: %016x', datapath.id)
                 del self.datapaths[datapath.id]  # Unregister and remove the datapath from the dictionary
+                self.poll_scheduler.remove(datapath.id)
     
-    # Asks for stats for all switches each sleep_timer
+    # Lets the scheduler ask for stats when each switch is due
     def _monitor(self):
-        sleep_timer = 30
         while True:
-            for dp in self.datapaths.values():
-                self._request_stats(dp)
-            hub.sleep(sleep_timer)
+            hub.sleep(self.poll_scheduler.tick())
+
+    def _poll_datapath(self, dpid):
+        datapath = self.datapaths.get(dpid)
+        if datapath is None:
+            return ()
+        return self._request_stats(datapath)
 
     def _request_stats(self, datapath):
         # Log a debug message indicating that statistics requests are being sent to the specified datapath
@@ -53,10 +61,14 @@ class SimpleMonitor13(simple_switch_13.SimpleSwitch13):
         req = parser.OFPPortStatsRequest(datapath, 0, ofproto.OFPP_ANY)
         datapath.send_msg(req)
 
+        # Only port stats are handled, the scheduler waits for that reply before polling again
+        return ('port',)
+
     # Handle replies for each switch
     @set_ev_cls(ofp_event.EventOFPPortStatsReply, MAIN_DISPATCHER)
     def _port_stats_reply_handler(self, ev):
         body = ev.msg.body
+        self.poll_scheduler.reply(ev.msg.datapath.id, 'port')
         # Header for console output 
         self.logger.info('datapath port rx-pkts rx-bytes rx-error tx-pkts tx-bytes tx-error')
         self.logger.info('---------------- -------- -------- -------- -------- -------- -------- --------')
@@ -0,0 +1,179 @@
+"""
+Bounded, NumPy backed time series for port and flow counters.
+
+Every series is a ring buffer of fixed capacity allocated on creation, so the memory used by a
+CounterStore only depends on the number of series and can be computed up front with
+CounterStore.footprint().
+Samples should be timestamped with `clock`, which never goes backwards, so that every series stays
+sorted by time.
+"""
+import numpy as np
+
+try:
+    from time import monotonic as clock
+except ImportError:
+    # Python 2
+    from time import time as clock
+
+PORT_FIELDS = ('rx_bytes', 'tx_bytes', 'rx_packets', 'tx_packets')
+FLOW_FIELDS = ('byte_count', 'packet_count')
+
+# Bytes per sample slot: one float64 timestamp plus one float64 per field
+_ITEM_SIZE = np.dtype(np.float64).itemsize
+
+
+class CounterRing(object):
+    """
+    Ring buffer holding the last `capacity` samples of a set of monotonic counters.
+    Counters are stored as float64, which is exact up to 2**53.
+    """
+    __slots__ = ('capacity', 'fields', 'times', 'values', 'head', 'count')
+
+    def __init__(self, capacity, fields):
+        self.capacity = capacity
+        self.fields = fields
+        self.times = np.zeros(capacity, dtype=np.float64)
+        self.values = np.zeros((capacity, len(fields)), dtype=np.float64)
+        # Index of the slot the next sample is written to
+        self.head = 0
+        self.count = 0
+
+    def append(self, timestamp, values):
+        # Lookups bisect the times, a sample older than the last one starts the series over
+        if self.count and timestamp < self.times[self.head - 1]:
+            self.clear()
+        self.times[self.head] = timestamp
+        self.values[self.head] = values
+        self.head = (self.head + 1) % self.capacity
+        if self.count < self.capacity:
+            self.count += 1
+
+    def clear(self):
+        self.head = 0
+        self.count = 0
+
+    def _indexes(self, n):
+        # Slot indexes of the last n samples, oldest first
+        n = self.count if n is None else min(n, self.count)
+        return np.arange(self.head - n, self.head) % self.capacity
+
+    def field_index(self, field):
+        return self.fields.index(field)
+
+    def last(self, n=None):
+        """
+        Returns (times, values) for the last n samples (all by default), oldest first.
+        values has one column per field.
+        """
+        indexes = self._indexes(n)
+        return self.times[indexes], self.values[indexes]
+
+    def rates(self, n=None):
+        """
+        Per-interval rates (units per second) between the last n samples.
+        Intervals where a counter went backwards (reset) are NaN.
+        :rtype : (numpy.ndarray, numpy.ndarray) -> end time of each interval, rates with one column per field
+        """
+        times, values = self.last(n)
+        if len(times) < 2:
+            return times[:0], values[:0]
+        intervals = np.diff(times)
+        deltas = np.diff(values, axis=0)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            rates = deltas / intervals[:, None]
+        rates[(deltas < 0) | (intervals[:, None] <= 0)] = np.nan
+        return times[1:], rates
+
+    def rate_over(self, window):
+        """
+        Average rate of every field over the last `window` seconds of samples.
+        Returns None if fewer than two samples fall in the window.
+        """
+        times, values = self.last()
+        if len(times) < 2:
+            return None
+        start = np.searchsorted(times, times[-1] - window)
+        if len(times) - start < 2:
+            return None
+        interval = times[-1] - times[start]
+        if interval <= 0:
+            return None
+        rates = (values[-1] - values[start]) / interval
+        rates[values[-1] < values[start]] = np.nan
+        return rates
+
+    def percentiles(self, field, q, n=None):
+        """
+        Percentiles `q` (0-100, scalar or sequence) of the per-interval rate of `field`.
+        """
+        _, rates = self.rates(n)
+        column = rates[:, self.field_index(field)]
+        column = column[~np.isnan(column)]
+        if len(column) == 0:
+            return None
+        return np.percentile(column, q)
+
+    @property
+    def nbytes(self):
+        return self.times.nbytes + self.values.nbytes
+
+
+class CounterStore(object):
+    """
+    Collection of CounterRing keyed by any hashable, e.g. (dpid, port_no) or (dpid, flow_key).
+    """
+    def __init__(self, capacity, fields):
+        self.capacity = capacity
+        self.fields = tuple(fields)
+        self.series = {}
+
+    @staticmethod
+    def series_nbytes(capacity, n_fields):
+        """
+        Bytes of sample storage used by one series.
+        """
+        return capacity * (1 + n_fields) * _ITEM_SIZE
+
+    @classmethod
+    def footprint(cls, n_series, capacity, n_fields=len(PORT_FIELDS)):
+        """
+        Sample storage needed by n_series series, e.g. footprint(10000, 360) for 10k ports
+        sampled every 10s during one hour.
+        """
+        return n_series * cls.series_nbytes(capacity, n_fields)
+
+    def ring(self, key):
+        ring = self.series.get(key)
+        if ring is None:
+            ring = CounterRing(self.capacity, self.fields)
+            self.series[key] = ring
+        return ring
+
+    def get(self, key):
+        return self.series.get(key)
+
+    def append(self, key, timestamp, values):
+        self.ring(key).append(timestamp, values)
+
+    def drop(self, key):
+        self.series.pop(key, None)
+
+    def drop_group(self, first):
+        """
+        Drops every series whose tuple key starts with `first`, e.g. every port of a datapath.
+        """
+        for key in [key for key in self.series if key[0] == first]:
+            del self.series[key]
+
+    def keys(self):
+        return self.series.keys()
+
+    def __len__(self):
+        return len(self.series)
+
+    def __contains__(self, key):
+        return key in self.series
+
+    @property
+    def nbytes(self):
+        return len(self.series) * self.series_nbytes(self.capacity, len(self.fields))
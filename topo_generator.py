@@ -0,0 +1,165 @@
+"""
+Parametric topologies for scale testing.
+
+Every generator returns an in-memory description
+
+    {'switches': [dpid], 'links': [(dpid, port, dpid, port)], 'hosts': [(mac, ip, dpid, port)]}
+
+with dpids numbered from 1 and ports numbered from 1 on every switch in the order links and then
+hosts are added, so the same parameters always give the same ports. Links are listed once and
+are bidirectional. The description feeds bench_controller.FakeNetwork directly and mininet_topo()
+turns it into a Mininet Topo, e.g.
+
+    sudo mn --custom topo_generator.py --topo fattree,4 --controller remote
+"""
+import networkx as nx
+
+
+class _Builder(object):
+    def __init__(self):
+        self.switches = []
+        self.links = []
+        self.hosts = []
+        self.next_port = {}
+
+    def switch(self):
+        dpid = len(self.switches) + 1
+        self.switches.append(dpid)
+        self.next_port[dpid] = 1
+        return dpid
+
+    def _port(self, dpid):
+        port = self.next_port[dpid]
+        self.next_port[dpid] = port + 1
+        return port
+
+    def link(self, a, b):
+        self.links.append((a, self._port(a), b, self._port(b)))
+
+    def host(self, dpid):
+        index = len(self.hosts) + 1
+        mac = '00:00:%02x:%02x:%02x:%02x' % ((index >> 24) & 0xff, (index >> 16) & 0xff, (index >> 8) & 0xff, index & 0xff)
+        ip = '10.%d.%d.%d' % ((index >> 16) & 0xff, (index >> 8) & 0xff, index & 0xff)
+        self.hosts.append((mac, ip, dpid, self._port(dpid)))
+
+    def hosts_on(self, dpids, count):
+        for dpid in dpids:
+            for _ in range(count):
+                self.host(dpid)
+
+    def topology(self):
+        return {'switches': self.switches, 'links': self.links, 'hosts': self.hosts}
+
+
+def fat_tree(k, hosts_per_edge=None):
+    """
+    k-ary fat-tree: (k/2)^2 core switches, k pods of k/2 aggregation and k/2 edge switches,
+    k/2 hosts per edge switch by default. k must be even.
+    """
+    if k < 2 or k % 2:
+        raise ValueError('k must be even and at least 2')
+    half = k // 2
+    builder = _Builder()
+    core = [builder.switch() for _ in range(half * half)]
+    edges = []
+    for _ in range(k):
+        aggregation = [builder.switch() for _ in range(half)]
+        pod_edges = [builder.switch() for _ in range(half)]
+        for i, agg in enumerate(aggregation):
+            for j in range(half):
+                builder.link(agg, core[i * half + j])
+        for edge in pod_edges:
+            for agg in aggregation:
+                builder.link(edge, agg)
+        edges.extend(pod_edges)
+    builder.hosts_on(edges, half if hosts_per_edge is None else hosts_per_edge)
+    return builder.topology()
+
+
+def leaf_spine(leaves, spines, hosts_per_leaf=1):
+    """
+    Every leaf connected to every spine, hosts on the leaves.
+    """
+    builder = _Builder()
+    spine_ids = [builder.switch() for _ in range(spines)]
+    leaf_ids = [builder.switch() for _ in range(leaves)]
+    for leaf in leaf_ids:
+        for spine in spine_ids:
+            builder.link(leaf, spine)
+    builder.hosts_on(leaf_ids, hosts_per_leaf)
+    return builder.topology()
+
+
+def ring(n, hosts_per_switch=1):
+    if n < 3:
+        raise ValueError('a ring needs at least 3 switches')
+    builder = _Builder()
+    ids = [builder.switch() for _ in range(n)]
+    for i, dpid in enumerate(ids):
+        builder.link(dpid, ids[(i + 1) % n])
+    builder.hosts_on(ids, hosts_per_switch)
+    return builder.topology()
+
+
+def random_regular(n, degree, seed=0, hosts_per_switch=1, attempts=100):
+    """
+    Connected random `degree`-regular graph (n * degree must be even). The seed makes it
+    reproducible; it is bumped until the graph is connected.
+    """
+    for attempt in range(attempts):
+        graph = nx.random_regular_graph(degree, n, seed=seed + attempt)
+        if nx.is_connected(graph):
+            break
+    else:
+        raise ValueError('no connected %d-regular graph on %d nodes after %d attempts' % (degree, n, attempts))
+    builder = _Builder()
+    ids = [builder.switch() for _ in range(n)]
+    for a, b in sorted(tuple(sorted(edge)) for edge in graph.edges()):
+        builder.link(ids[a], ids[b])
+    builder.hosts_on(ids, hosts_per_switch)
+    return builder.topology()
+
+
+GENERATORS = {
+    'fattree': fat_tree,
+    'leafspine': leaf_spine,
+    'ring': ring,
+    'random': random_regular,
+}
+
+
+def generate(spec):
+    """
+    Builds a topology from 'name:arg,arg', e.g. 'fattree:8', 'leafspine:32,4', 'random:200,4,7'.
+    """
+    name, _, args = spec.partition(':')
+    if name not in GENERATORS:
+        raise ValueError('unknown topology %r, expected one of %s' % (name, ', '.join(sorted(GENERATORS))))
+    return GENERATORS[name](*[int(arg) for arg in args.split(',') if arg])
+
+
+def mininet_topo(topology):
+    """
+    Mininet Topo with switches s<dpid>, hosts h<index> and the ports of `topology`.
+    """
+    from mininet.topo import Topo
+
+    class GeneratedTopo(Topo):
+        def build(self):
+            for dpid in topology['switches']:
+                self.addSwitch('s%d' % dpid, dpid='%016x' % dpid)
+            for a, a_port, b, b_port in topology['links']:
+                self.addLink('s%d' % a, 's%d' % b, port1=a_port, port2=b_port)
+            for index, (mac, ip, dpid, port) in enumerate(topology['hosts'], 1):
+                self.addHost('h%d' % index, mac=mac, ip=ip + '/8')
+                self.addLink('h%d' % index, 's%d' % dpid, port2=port)
+
+    return GeneratedTopo()
+
+
+topos = {
+    'fattree': lambda k=4: mininet_topo(fat_tree(k)),
+    'leafspine': lambda leaves=4, spines=2, hosts=1: mininet_topo(leaf_spine(leaves, spines, hosts)),
+    'ring': lambda n=6, hosts=1: mininet_topo(ring(n, hosts)),
+    'random': lambda n=20, degree=3, seed=0: mininet_topo(random_regular(n, degree, seed)),
+}